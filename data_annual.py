@@ -11,8 +11,17 @@ are single per tab. The reports are NOT in the same order.
 Will need to reorganize by report number.
 """
 
-import pandas as pd
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import data_cache
+import data_compact
+import data_dedupe
+import data_memo
+import data_lazy
+import data_trace
+pd = data_lazy.lazy_import('pandas')
 # =============================================================================
 # ANNUAL REPORTS PREPARATION: IMPORT DATA
 # =============================================================================
@@ -32,10 +41,10 @@ file_year = ['1970_2000',
              ]
 # Final file_folder in the correct folder dir
 # For now, use the 'annual_gas_transmission_gathering_2010_present' folder
-file_folder = file_dir + '\\' + file_cat[0] + '\\' + file_cat[0] + '_' + file_year[2]
+file_folder = os.path.join(file_dir, file_cat[0], file_cat[0] + '_' + file_year[2])
 
 # Variables for 2010 - Present
-var_gt_3 = ['incident_gas_transmission_gathering_jan2010_present.xlsx',
+var_gt_3 = ['annual_gas_transmission_gathering_2010_present.xlsx',
             # Part A - Key Report Information
              'OPERATOR_ID',             # 0 - Operator's 5 Digit Identification Number (OPID)
              'PARTA2NAMEOFCOMP',        # 1 - Operator Name
@@ -353,36 +362,9 @@ var_gt_3 = ['incident_gas_transmission_gathering_jan2010_present.xlsx',
              ]
 
 # Dataframe with variable mapping
-df_index = ['File Name',
-            # Operator Information
-            'Operator ID',
-            'Operator Name',
-            'Incident Date',
-            'Gas Released',
-            'System Part',
-            'Postal Code',
-            # Pipe Information
-            'Material',
-            'Pipe Failure',
-            'Pipe Diameter',
-            # If Material is Carbon Steel
-            'Pipe Wall Thickness',
-            'Pipe SMYS',
-            'Pipe Specification',
-            'Pipe Seam Type',
-            'Pipe Manufacturer',
-            'Pipe Coating Type',
-            # If Material is Plastic
-            'Plastic Type',
-            'Plastic SDR',
-            'Plastic Wall Thickness',
-            # General Information
-            'Installation Year',
-            'Manufactured Year',
-            # Failure Case Information
-            'Failure Cause',
-            'Failure Cause Details',
-            ]
+# The annual report variables have no descriptive names, so the PHMSA
+# variable names are used as the mapping index
+df_index = ['File Name'] + var_gt_3[1:]
 
 df_cats = ['gas_distribution',
            'gas_transmission',
@@ -390,18 +372,75 @@ df_cats = ['gas_distribution',
            'liquefied_natural',
            'mechanical_fit']
 
-df_cols = [# Gas Transmission & Gathering Incident Data
+df_cols = [# Gas Transmission & Gathering Annual Data, one per file_year
            df_cats[1] + '_0',
            df_cats[1] + '_1',
-           df_cats[1] + '_2',
-           df_cats[1] + '_3']
+           df_cats[1] + '_2']
+
+_df = None
+
+def mapping():
+    """
+    Variable mapping DataFrame (df). It is built on first use, so importing
+    this module does not import pandas.
+
+    Returns
+    -------
+    DataFrame
+        Source variable names, indexed by df_index, one column per dataset.
+
+    """
+    global _df
+    if _df is None:
+        _df = pd.DataFrame(index=df_index)
+        _df.insert(loc=0, column=df_cols[2], value=var_gt_3)
+    return _df
+
+def __getattr__(name):
+    # The module attribute df is the lazily built mapping
+    if name == 'df':
+        return mapping()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def mapped_columns(category_bin):
+    """
+    List the source columns of an annual dataset that are mapped in df. \n
+    ---------- \n
+    category_bin : str \n
+        Column of df, e.g. gas_transmission_2
+
+    Returns
+    -------
+    list of str
+        Source column names, without the file name.
+
+    """
+    return list(mapping()[category_bin].drop('File Name').dropna())
 
-df = pd.DataFrame(index=df_index)
-df.insert(loc=0, column=df_cols[3], value=var_gt_3)
+def file_path(category_bin):
+    """
+    Path to the PHMSA annual report workbook of a dataset. \n
+    ---------- \n
+    category_bin : str \n
+        Column of df, e.g. gas_transmission_2
+
+    Returns
+    -------
+    str
+        Path to the workbook.
+
+    """
+    return os.path.join(file_folder, mapping().loc['File Name', category_bin])
+
+def _sources(category, year_bin, **kwargs):
+    return [file_path(category + '_' + str(year_bin))]
 
 def data_report(category = 'gas_transmission', 
                 year_bin = 2, 
-                operator_id = 4906,
+                operator_id = None,
+                extra_columns = None,
+                compact = False,
+                latest = False,
                 ):
     """
     Select the PHMSA dataset and year bin. Data curation will be performed
@@ -417,26 +456,424 @@ def data_report(category = 'gas_transmission',
         0 ~ 1970-2000 \n
         1 ~ 2001-2009 \n
         2 ~ 2010-present
-    operator_id : int
+    operator_id : int or list of int
         Use the operator's 5 digit identification number (OPID).\n
-        For example: 4906 for ExxonMobil Pipeline Co
+        For example: 4906 for ExxonMobil Pipeline Co \n
+        A list of OPIDs is resolved in one pass. If None, all the operators
+        are returned.
+    extra_columns : list of str or 'all' \n
+        Only the mapped columns are read by default. Unmapped source columns
+        must be requested here, or 'all' to read the whole sheets.
+    compact : bool \n
+        Convert the data to compact dtypes (see data_compact). The bytes
+        saved per column are stored in data.attrs['bytes_saved'].
+    latest : bool \n
+        Keep only the latest supplement of every report (see data_dedupe).
 
     Returns
     -------
-    None.
+    df : DataFrame
+        Variable mapping.
+    data_A_D : DataFrame
+        Parts A to D.
+    data_F_G : DataFrame
+        Parts F to G.
 
     """
+    category_bin = category + '_' + str(year_bin)
+    df, data_A_D, data_F_G = _read_report(category, year_bin, extra_columns, compact)
+    if operator_id is not None:
+        # Only the rows of the requested operators, through the operator index.
+        # Without memoization the index is built from the frames already read,
+        # so the workbook is not parsed a second time
+        if data_memo.memo_enabled:
+            index_A_D, index_F_G = operator_index(category, year_bin, extra_columns, compact)
+        else:
+            index_A_D, index_F_G = OperatorIndex(data_A_D), OperatorIndex(data_F_G)
+        with data_trace.stage('operator_filter', category_bin,
+                              len(data_A_D) + len(data_F_G)) as stage:
+            if np.ndim(operator_id) == 0:
+                data_A_D = index_A_D.lookup(data_A_D, operator_id)
+                data_F_G = index_F_G.lookup(data_F_G, operator_id)
+            else:
+                data_A_D = index_A_D.lookup_many(data_A_D, operator_id)
+                data_F_G = index_F_G.lookup_many(data_F_G, operator_id)
+            stage.rows(len(data_A_D) + len(data_F_G))
+    if latest:
+        with data_trace.stage('latest_supplement', category_bin,
+                              len(data_A_D) + len(data_F_G)) as stage:
+            data_A_D = data_dedupe.latest_supplement(data_A_D)
+            data_F_G = data_dedupe.latest_supplement(data_F_G)
+            stage.rows(len(data_A_D) + len(data_F_G))
+    return df, data_A_D, data_F_G
 
-
+@data_memo.memoize(_sources)
+def _read_report(category, year_bin, extra_columns, compact):
+    # Columns to read: each sheet keeps the mapped columns it contains
+    category_bin = category + '_' + str(year_bin)
+    if extra_columns == 'all':
+        columns = None
+    else:
+        columns = mapped_columns(category_bin) + list(extra_columns or [])
 
     # Import the PHMSA report
     # This is only for the GT 2010-present
-    file_path = file_folder + '\\' + var_gt_3[0]
-    data_xlsx = pd.ExcelFile(file_path)
-    data_A_D = pd.read_excel(data_xlsx, 0) # GT AR Part A to D
-    data_F_G = pd.read_excel(data_xlsx, 1) # GT AR Part F to G
+    data_xlsx = file_path(category_bin)
+    with data_trace.stage('read_A_D', category_bin) as stage:
+        data_A_D = data_cache.read_excel(data_xlsx, 0, columns) # GT AR Part A to D
+        stage.rows(data_A_D)
+    with data_trace.stage('read_F_G', category_bin) as stage:
+        data_F_G = data_cache.read_excel(data_xlsx, 1, columns) # GT AR Part F to G
+        stage.rows(data_F_G)
+    if compact:
+        with data_trace.stage('compact', category_bin,
+                              len(data_A_D) + len(data_F_G)) as stage:
+            data_A_D, saved = data_compact.compact(data_A_D)
+            data_A_D.attrs['bytes_saved'] = saved['saved'].to_dict()
+            data_F_G, saved = data_compact.compact(data_F_G)
+            data_F_G.attrs['bytes_saved'] = saved['saved'].to_dict()
+            stage.rows(len(data_A_D) + len(data_F_G))
     # Parts H, I, J, K, L, M, P, Q, and R may have repeated entries
     # data_H   = pd.read_excel(data_xlsx, 0) # GT AR Part H
     # data_I   = pd.read_excel(data_xlsx, 0) # GT AR Part I
     # data_J   = pd.read_excel(data_xlsx, 0) # GT AR Part J
-    # When necessary, add the remaining data
\ No newline at end of file
+    # When necessary, add the remaining data
+
+    return mapping(), data_A_D, data_F_G
+
+# =============================================================================
+# ANNUAL REPORTS PREPARATION: ALL PARTS
+# =============================================================================
+
+# Keys shared by every part sheet of a report
+report_keys = ['REPORT_NUMBER', 'SUPPLEMENTAL_NUMBER']
+# Columns summed over the repeated entries of a report: the miles and counts
+# of the part sections. The Part A columns and the IDs and years (OPERATOR_ID,
+# REPORT_YEAR, ...) keep their first value
+summed_prefix = 'PART'
+first_prefixes = ('PARTA',)
+
+def _read_part(args):
+    # Worker: parse one part sheet through the columnar cache
+    data_xlsx, sheet_name, columns = args
+    return data_cache.read_excel(data_xlsx, sheet_name, columns)
+
+def _latest_rows(data):
+    # All the rows of the latest supplement of every report; parts with
+    # repeated entries have several rows per supplement
+    report, supplement = report_keys
+    latest = data.groupby(report, sort=False, observed=True)[supplement].transform('max')
+    return data[(data[supplement] == latest).to_numpy()]
+
+def _collapse(data, keys):
+    # Parts with repeated entries have several rows per report: the miles are
+    # summed and the first value of the other columns is kept
+    if not data.duplicated(keys).any():
+        return data.set_index(keys)
+    grouped = data.groupby(keys, sort=False, observed=True)
+    numeric = data.columns[[pd.api.types.is_numeric_dtype(t) for t in data.dtypes]]
+    numeric = [c for c in numeric if c not in keys and str(c).startswith(summed_prefix) and
+               not str(c).startswith(first_prefixes)]
+    others = [c for c in data.columns if c not in keys and c not in numeric]
+    parts = []
+    if numeric:
+        parts.append(grouped[numeric].sum(min_count=1))
+    if others:
+        parts.append(grouped[others].first())
+    return pd.concat(parts, axis=1)[[c for c in data.columns if c not in keys]]
+
+@data_memo.memoize(_sources, ignore=['max_workers'])
+def data_report_parts(category = 'gas_transmission', year_bin = 2, sheets = None,
+                      extra_columns = None, max_workers = None, latest = False):
+    """
+    Read all the part sheets of the annual report workbook concurrently and
+    join them into one wide frame with a single row per report. The sheets
+    are joined on REPORT_NUMBER and SUPPLEMENTAL_NUMBER with a hash join, so
+    their row order does not matter. When a report has several rows in a
+    sheet (Parts H to R), the part columns (miles) are summed and the IDs,
+    years and Part A columns keep their first value. \n
+    ---------- \n
+    category : str \n
+        Same as data_report.
+    year_bin : int \n
+        Same as data_report.
+    sheets : list of int or str \n
+        Sheets to read. The first one is the base of the join (Parts A to D).
+        If None, every sheet of the workbook is read.
+    extra_columns : list of str or 'all' \n
+        Same as data_report.
+    max_workers : int \n
+        Number of worker processes. Defaults to one per sheet.
+    latest : bool \n
+        Keep only the latest supplement of every report (see data_dedupe).
+        Raises a ValueError if a sheet has no SUPPLEMENTAL_NUMBER. Without
+        latest, such sheets are joined on REPORT_NUMBER alone and the other
+        sheets keep their latest supplement.
+
+    Returns
+    -------
+    df : DataFrame
+        Variable mapping.
+    data : DataFrame
+        One row per report, indexed by REPORT_NUMBER and
+        SUPPLEMENTAL_NUMBER, with the columns of every part.
+
+    """
+    category_bin = category + '_' + str(year_bin)
+    data_xlsx = file_path(category_bin)
+    if sheets is None:
+        sheets = pd.ExcelFile(data_xlsx).sheet_names
+    if extra_columns == 'all':
+        columns = None
+    else:
+        columns = report_keys + mapped_columns(category_bin) + list(extra_columns or [])
+
+    # Each sheet is parsed in its own worker process
+    tasks = [(data_xlsx, sheet_name, columns) for sheet_name in sheets]
+    with data_trace.stage('read_parts', category_bin) as stage:
+        with ProcessPoolExecutor(max_workers=max_workers or len(tasks)) as pool:
+            parts = list(pool.map(_read_part, tasks))
+        stage.rows(sum(len(part) for part in parts))
+
+    # Join on both keys when every sheet has them
+    keys = [k for k in report_keys if all(k in part.columns for part in parts)]
+    if report_keys[0] not in keys:
+        raise ValueError('The sheets do not share a REPORT_NUMBER column')
+    if keys != report_keys:
+        # Joined on the report number only: the sheets with supplements keep
+        # the rows of the latest one, so the supplements are not summed
+        # together. The other sheets cannot be deduplicated
+        missing = [sheet for sheet, part in zip(sheets, parts) if report_keys[1] not in part.columns]
+        if latest:
+            raise ValueError('Sheets {} have no SUPPLEMENTAL_NUMBER: the latest supplement cannot '
+                             'be selected'.format(missing))
+        parts = [_latest_rows(part) if report_keys[1] in part.columns else part for part in parts]
+    with data_trace.stage('join_parts', category_bin, sum(len(part) for part in parts)) as stage:
+        # Left join of every part on the base sheet: the collapsed parts are
+        # aligned to the base index and added with a single concat, so the
+        # frame is not fragmented by one join per sheet
+        base = _collapse(parts[0], keys)
+        frames = [base]
+        seen = set(base.columns)
+        for part in parts[1:]:
+            # Columns repeated across sheets (OPERATOR_ID, REPORT_YEAR, ...)
+            # are only kept from the base sheet
+            part = part[[c for c in part.columns if c in keys or c not in seen]]
+            if len(part.columns) > len(keys):
+                part = _collapse(part, keys)
+                frames.append(part.reindex(base.index))
+                seen.update(part.columns)
+        data = pd.concat(frames, axis=1)
+        stage.rows(data)
+    if latest:
+        with data_trace.stage('latest_supplement', category_bin, data) as stage:
+            data = data_dedupe.latest_supplement(data)
+            stage.rows(data)
+    return mapping(), data
+
+# =============================================================================
+# ANNUAL REPORTS PREPARATION: BIN ARRAYS
+# =============================================================================
+
+# Part H and I bins: Nominal Pipe Size (NPS) in inches. The first bin is
+# 4 inches or less and the last one 58 inches and over
+nps_bins = ['4LESS', '6', '8', '10', '12', '14', '16', '18', '20', '22', '24',
+            '26', '28', '30', '32', '34', '36', '38', '42', '44', '46', '48',
+            '52', '56', '58OVER']
+nps_inches = np.array([4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26, 28, 30,
+                       32, 34, 36, 38, 42, 44, 46, 48, 52, 56, 58], dtype=np.float32)
+# Part J bins: decade installed. The first bin is before 1940, the unknown
+# decade is not a bin
+decade_bins = ['PRE1940', '194049', '195059', '196069', '197079', '198089',
+               '199099', '200009', '201019', '202029']
+decade_start = np.array([-np.inf, 1940, 1950, 1960, 1970, 1980, 1990, 2000,
+                         2010, 2020], dtype=np.float32)
+decade_end = np.append(decade_start[1:], 2030).astype(np.float32)
+
+# Columns of each part, in bin order
+bin_columns = {'H': {'onshore': ['PARTHON' + b for b in nps_bins],
+                     'offshore': ['PARTHOFF' + b for b in nps_bins]},
+               'I': {'onshore_a': ['PARTIONA' + b for b in nps_bins],
+                     'onshore_b': ['PARTIONB' + b for b in nps_bins],
+                     'offshore': ['PARTIOFF' + b for b in nps_bins]},
+               'J': {'onshore': ['PARTJTON' + b for b in decade_bins],
+                     'offshore': ['PARTJTOFF' + b for b in decade_bins],
+                     'total': ['PARTJT' + b + 'TOT' for b in decade_bins]},
+               }
+bin_edges = {'H': nps_inches,
+             'I': nps_inches,
+             'J': decade_start}
+
+def bin_arrays(data, part = 'H'):
+    """
+    Turn the wide bin columns of Part H, I or J into 2-D float32 arrays with
+    one row per report and one column per bin. Missing miles are zero. \n
+    ---------- \n
+    data : DataFrame \n
+        Annual report data with the part columns, e.g. the output of
+        data_report_parts.
+    part : str \n
+        H ~ transmission miles by NPS \n
+        I ~ gathering miles by NPS \n
+        J ~ transmission miles by decade installed
+
+    Returns
+    -------
+    arrays : dict
+        keys  : DataFrame, report keys of each row (REPORT_NUMBER,
+                SUPPLEMENTAL_NUMBER and OPERATOR_ID when available)
+        edges : ndarray, NPS inches (H, I) or decade start year (J), shared
+                by all the arrays
+        one ndarray (reports x bins) per group, e.g. onshore, offshore
+
+    Examples
+    --------
+    Onshore miles of 30 inch and over per report: \n
+        h = bin_arrays(data, 'H') \n
+        h['onshore'][:, h['edges'] >= 30].sum(axis=1) \n
+    Parts H and J are separate distributions; assuming they are independent,
+    the miles by (NPS, decade) of each report are: \n
+        j = bin_arrays(data, 'J') \n
+        share = j['onshore'] / j['onshore'].sum(axis=1, keepdims=True) \n
+        h['onshore'][:, :, None] * share[:, None, :]
+
+    """
+    # Key columns from the index levels and the columns, without resetting
+    # the index of the whole frame
+    names = report_keys + ['OPERATOR_ID', 'REPORT_YEAR']
+    levels = [name for name in data.index.names if name is not None]
+    keys = {name: data.index.get_level_values(name) for name in names if name in levels}
+    keys.update({name: data[name].to_numpy() for name in names
+                 if name in data.columns and name not in keys})
+    keys = pd.DataFrame({name: keys[name] for name in names if name in keys})
+    arrays = {'keys': keys,
+              'edges': bin_edges[part]}
+    for group, columns in bin_columns[part].items():
+        values = data.reindex(columns=columns)
+        arrays[group] = values.to_numpy(dtype=np.float32, na_value=0.0)
+    return arrays
+
+def operator_totals(values, operator_ids):
+    """
+    Add the rows of a bin array per operator. \n
+    ---------- \n
+    values : ndarray \n
+        Array of bin_arrays, reports x bins.
+    operator_ids : array_like \n
+        OPID of each row, e.g. arrays['keys']['OPERATOR_ID'].
+
+    Returns
+    -------
+    operators : ndarray
+        Sorted OPIDs.
+    totals : ndarray
+        Miles per operator and bin, operators x bins.
+
+    """
+    operators, inverse = np.unique(np.asarray(operator_ids), return_inverse=True)
+    totals = np.zeros((len(operators),) + values.shape[1:], dtype=values.dtype)
+    np.add.at(totals, inverse, values)
+    return operators, totals
+
+# =============================================================================
+# ANNUAL REPORTS PREPARATION: OPERATOR INDEX
+# =============================================================================
+
+class OperatorIndex:
+    """
+    Index from OPERATOR_ID to the rows of an annual report sheet. The rows
+    are ordered by OPERATOR_ID and REPORT_YEAR once; a single operator is
+    then found with a binary search and its rows are taken directly. \n
+    ---------- \n
+    data : DataFrame \n
+        Annual report sheet with an OPERATOR_ID column.
+    """
+
+    def __init__(self, data):
+        ids = data['OPERATOR_ID'].to_numpy()
+        if 'REPORT_YEAR' in data.columns:
+            order = np.lexsort((data['REPORT_YEAR'].to_numpy(), ids))
+        else:
+            order = np.argsort(ids, kind='stable')
+        # Row positions sorted by operator, and the range of each operator
+        self.order = order
+        self.keys, self.starts = np.unique(ids[order], return_index=True)
+        self.stops = np.append(self.starts[1:], len(ids))
+
+    def positions(self, operator_ids):
+        """
+        Row positions of several operators, in the order requested. \n
+        ---------- \n
+        operator_ids : array_like \n
+            OPIDs to look up. Unknown OPIDs have no rows.
+
+        Returns
+        -------
+        ndarray
+            Row positions in the indexed data.
+
+        """
+        operator_ids = np.asarray(operator_ids)
+        found = np.searchsorted(self.keys, operator_ids)
+        valid = found < len(self.keys)
+        valid[valid] = self.keys[found[valid]] == operator_ids[valid]
+        found = found[valid]
+        starts = self.starts[found]
+        lengths = self.stops[found] - starts
+        # Concatenate the row ranges without a Python loop
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.order[offsets + np.arange(lengths.sum())]
+
+    def lookup(self, data, operator_id):
+        """
+        Rows of a single operator. \n
+        ---------- \n
+        data : DataFrame \n
+            The data the index was built from.
+        operator_id : int \n
+            OPID to look up.
+
+        Returns
+        -------
+        DataFrame
+            Rows of the operator, ordered by REPORT_YEAR.
+
+        """
+        i = np.searchsorted(self.keys, operator_id)
+        if i == len(self.keys) or self.keys[i] != operator_id:
+            return data.iloc[:0]
+        return data.iloc[self.order[self.starts[i]:self.stops[i]]]
+
+    def lookup_many(self, data, operator_ids):
+        """
+        Rows of several operators, resolved in one vectorized pass. \n
+        ---------- \n
+        data : DataFrame \n
+            The data the index was built from.
+        operator_ids : array_like \n
+            OPIDs to look up.
+
+        Returns
+        -------
+        DataFrame
+            Rows of the operators, grouped by operator.
+
+        """
+        return data.iloc[self.positions(operator_ids)]
+
+@data_memo.memoize(_sources)
+def operator_index(category = 'gas_transmission', year_bin = 2, extra_columns = None, compact = False):
+    """
+    Operator index of the Part A to D and Part F to G sheets. It is built
+    once per source workbook and persisted in the cache directory. \n
+    ---------- \n
+    Same arguments as data_report.
+
+    Returns
+    -------
+    index_A_D, index_F_G : OperatorIndex
+        Index of each sheet.
+
+    """
+    _, data_A_D, data_F_G = _read_report(category, year_bin, extra_columns, compact)
+    return OperatorIndex(data_A_D), OperatorIndex(data_F_G)
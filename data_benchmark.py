@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks
+
+The objective of this module is to time and memory-profile the pipeline on
+the synthetic data of data_synthetic: ingestion (workbook, columnar cache,
+parquet), curation, the annual report joins, the incident rates and the
+plots.
+
+Every case runs in a fresh working folder with the synthetic files, the
+in-memory memoization disabled and, unless stated otherwise, a cold
+columnar cache. The results of each run are appended to a JSON lines history
+file. A case is flagged as a regression when its time or peak memory exceeds
+the median of its previous runs (same case and row count) by more than
+the tolerance.
+
+From the command line:
+    python data_benchmark.py --rows 1000 100000 --repeat 3
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import data_annual
+import data_cache
+import data_incident
+import data_lazy
+import data_memo
+import data_synthetic
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# BENCHMARK SETTINGS
+# =============================================================================
+
+# Folder of the synthetic datasets, one subfolder per row count
+data_dir = os.path.join('benchmarks', 'data')
+# History of the results, one JSON object per case and run
+history_file = os.path.join('benchmarks', 'history.jsonl')
+# Previous runs compared against, and the allowed slowdown or memory growth
+history_window = 5
+tolerance = 0.2
+# Annual rows generated for a given number of incident rows
+annual_ratio = 1
+
+# =============================================================================
+# CASES
+# =============================================================================
+# Each case runs its setup (e.g. warming the cache) in the dataset folder and
+# returns the callable that is timed
+
+def _incident_columns():
+    return data_incident.mapped_columns('gas_transmission_3')
+
+def _incident_path():
+    return data_incident.file_path('gas_transmission_3')
+
+def _read_excel():
+    data_cache.cache_enabled = False
+    return lambda: data_cache.read_excel(_incident_path(), columns=_incident_columns())
+
+def _read_cached():
+    data_cache.read_excel(_incident_path(), columns=_incident_columns())
+    return lambda: data_cache.read_excel(_incident_path(), columns=_incident_columns())
+
+def _read_parquet():
+    path = os.path.splitext(_incident_path())[0] + '.parquet'
+    return lambda: pd.read_parquet(path, columns=_incident_columns())
+
+def _curate():
+    data = data_cache.read_excel(_incident_path(), columns=_incident_columns())
+    return lambda: data_incident.curate(data, 'gas_transmission_3')
+
+def _annual_report():
+    data_cache.read_excel(data_annual.file_path('gas_transmission_2'), 0)
+    data_cache.read_excel(data_annual.file_path('gas_transmission_2'), 1)
+    return lambda: data_annual.data_report(latest=True)
+
+def _annual_parts():
+    return lambda: data_annual.data_report_parts(latest=True, max_workers=1)
+
+def _rates():
+    # Same inputs as the rates stage of data_pipeline: the loaded incidents of
+    # the cause and material, and the latest supplement of every report
+    import data_pipeline
+    import data_rate
+    columns = data_incident.mapped_columns('gas_transmission_3') + data_annual.report_keys
+    data = data_cache.read_excel(_incident_path(), columns=columns)
+    data = data_pipeline.counted_incidents(data, 'gas_transmission_3')
+    annual = data_annual.data_report(latest=True)[1]
+    return lambda: data_rate.incident_rates(data, annual, latest=False)
+
+def _plot(name):
+    def setup():
+        import results_plot
+        data = data_incident.data_incident()[1]
+        spec = {'plot': name, 'data': data, 'df': data_incident.mapping(),
+                'path': os.path.join('plots', name + '.png')}
+        return lambda: results_plot.render(spec)
+    return setup
+
+cases = {'read_excel': _read_excel,
+         'read_cached': _read_cached,
+         'read_parquet': _read_parquet,
+         'curate': _curate,
+         'annual_report': _annual_report,
+         'annual_parts': _annual_parts,
+         'rates': _rates,
+         'plot_hist': _plot('hist'),
+         'plot_scatter_matrix': _plot('scatter_matrix'),
+         }
+
+# =============================================================================
+# RUNNER
+# =============================================================================
+
+def dataset(rows, seed = 0):
+    """
+    Folder with the synthetic data of a row count, generated on first use. \n
+    ---------- \n
+    rows : int \n
+        Incident rows. The annual rows are rows * annual_ratio.
+    seed : int \n
+        Seed of the data.
+
+    Returns
+    -------
+    str
+        Absolute path of the folder.
+
+    """
+    folder = os.path.abspath(os.path.join(data_dir, '{}_{}'.format(rows, seed)))
+    done = os.path.join(folder, 'generated.json')
+    if not os.path.exists(done):
+        paths = data_synthetic.generate(folder, rows, int(rows * annual_ratio), seed)
+        with open(done, 'w') as f:
+            json.dump({'rows': rows, 'seed': seed, 'files': paths}, f, indent=1)
+    return folder
+
+def _measure(name, folder, repeat):
+    # Time the case repeat times, then measure its peak memory once; every
+    # measurement starts from a cold cache and default settings
+    settings = (data_cache.cache_dir, data_cache.cache_enabled, data_memo.memo_enabled,
+                data_memo.disk_enabled)
+    cwd = os.getcwd()
+    seconds = []
+    try:
+        os.chdir(folder)
+        for i in range(repeat + 1):
+            data_cache.cache_dir = 'cache_bench'
+            data_cache.clear()
+            data_memo.memo_enabled = False
+            data_memo.disk_enabled = False
+            func = cases[name]()
+            if i < repeat:
+                start = time.perf_counter()
+                func()
+                seconds.append(time.perf_counter() - start)
+            else:
+                tracemalloc.start()
+                func()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            data_cache.cache_enabled = True
+    finally:
+        data_cache.clear()
+        (data_cache.cache_dir, data_cache.cache_enabled, data_memo.memo_enabled,
+         data_memo.disk_enabled) = settings
+        os.chdir(cwd)
+    return {'seconds': float(np.median(seconds)),
+            'best_seconds': float(np.min(seconds)),
+            'peak_mb': peak / 2**20}
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def history(file_path = None):
+    """
+    Read the benchmark history. \n
+    ---------- \n
+    file_path : str \n
+        History file. Defaults to history_file.
+
+    Returns
+    -------
+    DataFrame
+        One row per case and run.
+
+    """
+    file_path = file_path or history_file
+    if not os.path.exists(file_path):
+        return pd.DataFrame(columns=['time', 'commit', 'case', 'rows', 'seconds', 'best_seconds',
+                                     'peak_mb'])
+    with open(file_path, 'r') as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+def compare(results, previous):
+    """
+    Flag the regressions of a run against the previous runs. \n
+    ---------- \n
+    results : DataFrame \n
+        Results of the run: case, rows, seconds and peak_mb.
+    previous : DataFrame \n
+        History before the run.
+
+    Returns
+    -------
+    DataFrame
+        results with the baseline seconds and peak_mb (median of the last
+        history_window runs), their ratios and the regression flag.
+
+    """
+    results = results.copy()
+    baseline = {}
+    if len(previous):
+        recent = previous.groupby(['case', 'rows'], sort=False).tail(history_window)
+        baseline = recent.groupby(['case', 'rows'])[['seconds', 'peak_mb']].median()
+        baseline = {key: row for key, row in baseline.iterrows()}
+    base_seconds = [baseline[key]['seconds'] if key in baseline else np.nan
+                    for key in zip(results['case'], results['rows'])]
+    base_peak = [baseline[key]['peak_mb'] if key in baseline else np.nan
+                 for key in zip(results['case'], results['rows'])]
+    results['baseline_seconds'] = base_seconds
+    results['baseline_peak_mb'] = base_peak
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results['time_ratio'] = results['seconds'] / results['baseline_seconds']
+        results['memory_ratio'] = results['peak_mb'] / results['baseline_peak_mb']
+    results['regression'] = (results['time_ratio'] > 1 + tolerance) | \
+        (results['memory_ratio'] > 1 + tolerance)
+    return results
+
+def run(rows = (1000, 10000), names = None, repeat = 3, seed = 0, record = True):
+    """
+    Run the benchmark cases on the synthetic data of every row count. \n
+    ---------- \n
+    rows : list of int \n
+        Incident row counts, from 1k to 10M. Row counts beyond the Excel
+        sheet limit only have the columnar data, so the workbook cases are
+        skipped for them.
+    names : list of str \n
+        Cases to run. Defaults to every case in cases.
+    repeat : int \n
+        Timed repetitions; the median is reported.
+    seed : int \n
+        Seed of the synthetic data.
+    record : bool \n
+        Append the results to the history file.
+
+    Returns
+    -------
+    DataFrame
+        One row per case and row count: seconds (median), best_seconds,
+        peak_mb (peak of the Python allocations, tracemalloc) and the
+        comparison with the history (see compare).
+
+    """
+    names = list(names or cases)
+    previous = history()
+    results = []
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    commit = _commit()
+    for count in rows:
+        folder = dataset(count, seed)
+        workbook = os.path.exists(os.path.join(folder, _incident_path()))
+        for name in names:
+            if not workbook and name != 'read_parquet':
+                continue
+            result = _measure(name, folder, repeat)
+            results.append(dict(time=stamp, commit=commit, case=name, rows=count, **result))
+    results = pd.DataFrame(results)
+    if record and len(results):
+        os.makedirs(os.path.dirname(history_file) or '.', exist_ok=True)
+        with open(history_file, 'a') as f:
+            for row in results.to_dict('records'):
+                f.write(json.dumps(row) + '\n')
+    return compare(results, previous)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmark the PHMSA pipeline on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000],
+                        help='incident row counts (default: 1000 10000)')
+    parser.add_argument('--cases', nargs='+', default=None, choices=sorted(cases),
+                        help='cases to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed repetitions')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--no-record', action='store_true', help='do not append to the history')
+    args = parser.parse_args(argv)
+
+    results = run(args.rows, args.cases, args.repeat, args.seed, not args.no_record)
+    columns = ['case', 'rows', 'seconds', 'peak_mb', 'time_ratio', 'memory_ratio', 'regression']
+    print(results[columns].to_string(index=False, float_format='{:.3f}'.format))
+    return int(results['regression'].any())
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar Data Cache
+
+The objective of this module is to avoid parsing the PHMSA Excel workbooks on
+every run. The first read of a workbook sheet is converted into a columnar
+binary file (Parquet, or a pickle if pyarrow is not installed) and all later
+reads are served from it.
+
+A cached sheet is invalidated when the source workbook changes. The size and
+modification time are checked first; the content hash is only recomputed when
+the size matches but the modification time does not (e.g. the same PHMSA file
+was downloaded again).
+"""
+
+import hashlib
+import json
+import os
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# CACHE SETTINGS
+# =============================================================================
+
+# Directory where the cached sheets are stored
+cache_dir = 'cache'
+# Set to False to always read directly from the Excel workbooks
+cache_enabled = True
+
+# =============================================================================
+# SOURCE FILE FINGERPRINT
+# =============================================================================
+
+def file_hash(file_path, block_size=1 << 20):
+    """
+    Compute the SHA-256 content hash of a file. \n
+    ---------- \n
+    file_path : str \n
+        Path to the source file.
+    block_size : int \n
+        Number of bytes read per block.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest of the file content.
+
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def fingerprint(file_path):
+    """
+    Build the fingerprint of a source file: size, mtime and content hash. \n
+    ---------- \n
+    file_path : str \n
+        Path to the source file.
+
+    Returns
+    -------
+    dict
+        Keys 'size', 'mtime_ns' and 'sha256'.
+
+    """
+    stat = os.stat(file_path)
+    return {'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_hash(file_path)}
+
+def _is_valid(file_path, meta):
+    # Compare the stored fingerprint against the current source file
+    stat = os.stat(file_path)
+    if meta.get('size') != stat.st_size:
+        return False
+    if meta.get('mtime_ns') == stat.st_mtime_ns:
+        return True
+    # Same size but touched: only the content hash can tell
+    if meta.get('sha256') != file_hash(file_path):
+        return False
+    meta['mtime_ns'] = stat.st_mtime_ns
+    _write_meta(meta)
+    return True
+
+# =============================================================================
+# CACHE FILES
+# =============================================================================
+
+def _source_key(file_path):
+    # Readable file name plus a short hash of the absolute source path
+    source = os.path.abspath(file_path)
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()[:10]
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return name, key
+
+def _cache_stem(file_path, sheet_name):
+    # Unique stem per source path and sheet
+    name, key = _source_key(file_path)
+    return os.path.join(cache_dir, '{}.{}.{}'.format(name, sheet_name, key))
+
+def _read_meta(stem):
+    try:
+        with open(stem + '.json', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_meta(meta):
+    with open(meta['stem'] + '.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+
+def _write_data(data, stem):
+    # Parquet is preferred; mixed-type object columns or a missing pyarrow
+    # fall back to a pickle, which is still much faster than the workbook
+    try:
+        data.to_parquet(stem + '.parquet')
+        return 'parquet'
+    except (ImportError, ValueError, TypeError):
+        if os.path.exists(stem + '.parquet'):
+            os.remove(stem + '.parquet')
+        data.to_pickle(stem + '.pkl')
+        return 'pickle'
+
+def _read_data(meta, columns=None):
+    if meta['format'] == 'parquet':
+        return pd.read_parquet(meta['stem'] + '.parquet', columns=columns)
+    data = pd.read_pickle(meta['stem'] + '.pkl')
+    return data if columns is None else data[columns]
+
+def clear(file_path=None):
+    """
+    Remove cached sheets. \n
+    ---------- \n
+    file_path : str \n
+        Only remove the sheets of this source workbook. If None, every
+        cached sheet is removed. The subfolders of other caches (memo,
+        models, ...) are kept.
+
+    Returns
+    -------
+    None.
+
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    if file_path is not None:
+        source_name, key = _source_key(file_path)
+    for name in os.listdir(cache_dir):
+        if not os.path.isfile(os.path.join(cache_dir, name)):
+            continue
+        if file_path is None or (name.startswith(source_name + '.') and
+                                 '.' + key + '.' in name):
+            os.remove(os.path.join(cache_dir, name))
+
+# =============================================================================
+# CACHED READ
+# =============================================================================
+
+def _parse_excel(file_path, sheet_name, columns):
+    # Parse only the requested columns; the header is recorded as a side
+    # effect of the usecols callable, so no extra pass is needed
+    header = []
+    def usecols(name):
+        header.append(name)
+        return columns is None or name in columns
+    data = pd.read_excel(file_path, sheet_name=sheet_name, usecols=usecols)
+    return data, header
+
+def _select(columns, header):
+    # Keep the requested columns that exist in the sheet, in request order
+    present = set(header)
+    return [c for c in columns if c in present]
+
+def read_excel(file_path, sheet_name=0, columns=None):
+    """
+    Read a sheet of an Excel workbook through the columnar cache. \n
+    ---------- \n
+    file_path : str \n
+        Path to the PHMSA workbook.
+    sheet_name : int or str \n
+        Sheet to read, same as pd.read_excel.
+    columns : list of str \n
+        Only parse these columns. Requested columns that are not in the sheet
+        are ignored. If None, every column is read.
+
+    Returns
+    -------
+    data : DataFrame
+        Contents of the sheet.
+
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))
+    if not cache_enabled:
+        return _parse_excel(file_path, sheet_name, columns)[0]
+
+    stem = _cache_stem(file_path, sheet_name)
+    meta = _read_meta(stem)
+    if meta is not None and 'header' in meta and _is_valid(file_path, meta):
+        if columns is None:
+            wanted = meta['header']
+        else:
+            wanted = _select(columns, meta['header'])
+        missing = [c for c in wanted if c not in meta['columns']]
+        if not missing:
+            return _read_data(meta, wanted)
+        # Cache hit with missing columns: parse only those and widen the cache
+        cached = _read_data(meta)
+        extra = _parse_excel(file_path, sheet_name, set(missing))[0]
+        data = pd.concat([cached, extra], axis=1)
+        data = data[[c for c in meta['header'] if c in data.columns]]
+        meta['columns'] = list(data.columns)
+        meta['format'] = _write_data(data, stem)
+        _write_meta(meta)
+        return data[wanted]
+
+    # Cache miss: parse the workbook and store the columnar copy
+    data, header = _parse_excel(file_path, sheet_name,
+                                None if columns is None else set(columns))
+    os.makedirs(cache_dir, exist_ok=True)
+    meta = fingerprint(file_path)
+    meta['stem'] = stem
+    meta['source'] = os.path.abspath(file_path)
+    meta['sheet_name'] = sheet_name
+    meta['header'] = header
+    meta['columns'] = list(data.columns)
+    meta['format'] = _write_data(data, stem)
+    _write_meta(meta)
+    if columns is None:
+        return data
+    return data[_select(columns, header)]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Compact Data Types
+
+The objective of this module is to reduce the memory used by the incident
+and annual report data. Repeated strings become categoricals and numeric
+columns are downcast to the smallest dtype that keeps their values:
+    IDs and codes   : smallest signed integer, if there are no missing values
+    measurements    : float32, if the values round-trip within tolerance
+Measurements (miles, lengths, ...) are never stored as integers, even when
+their values are whole, so later arithmetic cannot wrap around.
+"""
+
+import numpy as np
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# COMPACT SETTINGS
+# =============================================================================
+
+# Repeated strings of the incident and annual report data
+categorical_columns = ['NAME',
+                       'PARTA2NAMEOFCOMP',
+                       'PARTA5COMMODITY',
+                       'COMMODITY_RELEASED_TYPE',
+                       'SYSTEM_PART_INVOLVED',
+                       'MATERIAL_INVOLVED',
+                       'ITEM_INVOLVED',
+                       'PIPE_SPECIFICATION',
+                       'PIPE_SEAM_TYPE',
+                       'PIPE_MANUFACTURER',
+                       'PIPE_COATING_TYPE',
+                       'PLASTIC_TYPE',
+                       'CAUSE',
+                       'CAUSE_DETAILS',
+                       ]
+# Identifiers and codes that can be stored as integers. Other numeric columns
+# are measurements
+integer_columns = ['OPERATOR_ID',
+                   'REPORT_NUMBER',
+                   'SUPPLEMENTAL_NUMBER',
+                   'REPORT_YEAR',
+                   'ONSHORE_POSTAL_CODE',
+                   'INSTALLATION_YEAR',
+                   'MANUFACTURED_YEAR',
+                   ]
+# Other text columns become categoricals below this unique/rows ratio
+categorical_ratio = 0.5
+# Relative tolerance for float64 to float32
+float_rtol = 1e-6
+
+# =============================================================================
+# COLUMN CONVERSION
+# =============================================================================
+
+def _is_text(values):
+    return values.dtype == object or pd.api.types.is_string_dtype(values.dtype)
+
+def _downcast(values, integer = False):
+    # Smallest safe numeric dtype of a column, or the column unchanged. Only
+    # IDs and codes (integer) become integers, always signed
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return values
+    array = values.to_numpy(dtype=np.float64)
+    finite = np.isfinite(array)
+    if integer:
+        if pd.api.types.is_integer_dtype(values.dtype):
+            return pd.to_numeric(values, downcast='integer')
+        if finite.all() and np.array_equal(array, np.round(array)):
+            return pd.to_numeric(values.astype(np.int64), downcast='integer')
+    if pd.api.types.is_integer_dtype(values.dtype) or pd.api.types.is_float_dtype(values.dtype):
+        array32 = array.astype(np.float32)
+        if np.allclose(array32[finite], array[finite], rtol=float_rtol, atol=0):
+            return pd.Series(array32, index=values.index, name=values.name)
+    return values
+
+def compact(data, columns=None):
+    """
+    Convert the columns of a dataset to compact dtypes. \n
+    ---------- \n
+    data : DataFrame \n
+        Incident or annual report data.
+    columns : list of str \n
+        Text columns converted to categoricals regardless of their
+        cardinality. Defaults to categorical_columns.
+
+    Returns
+    -------
+    data : DataFrame
+        Data with compact dtypes.
+    saved : DataFrame
+        Bytes before and after, and bytes saved per column.
+
+    """
+    if columns is None:
+        columns = categorical_columns
+    columns = set(columns)
+    before = data.memory_usage(index=False, deep=True)
+
+    converted = {}
+    for name in data.columns:
+        values = data[name]
+        if isinstance(values, pd.DataFrame):
+            # Duplicated column names are left as they are
+            continue
+        if _is_text(values):
+            if name in columns or \
+                    values.nunique(dropna=True) <= categorical_ratio * len(values):
+                converted[name] = values.astype('category')
+        elif pd.api.types.is_numeric_dtype(values.dtype):
+            values = _downcast(values, name in integer_columns)
+            if values.dtype != data[name].dtype:
+                converted[name] = values
+    data = data.assign(**converted) if converted else data
+
+    after = data.memory_usage(index=False, deep=True)
+    saved = pd.DataFrame({'before': before, 'after': after})
+    saved['saved'] = saved['before'] - saved['after']
+    return data, saved
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Supplemental Report Deduplication
+
+The objective of this module is to keep a single version of every PHMSA
+report. Operators file supplements to their annual and incident reports, and
+adding the rows of every supplement double counts the miles and incidents.
+
+The latest supplement of each report is found with one sort of the report
+and supplement numbers. Optionally, the older supplements are kept as a
+delta table with only the values that changed between consecutive
+supplements.
+"""
+
+import numpy as np
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# LATEST SUPPLEMENT
+# =============================================================================
+
+def _values(data, name):
+    # Column or index level of the data
+    if name in data.columns:
+        return data[name].to_numpy()
+    return data.index.get_level_values(name).to_numpy()
+
+def _same(a, b):
+    # Element-wise equality where two missing values are equal
+    equal = np.asarray(a == b, dtype=bool)
+    return equal | (pd.isna(a) & pd.isna(b))
+
+def latest_supplement(data, report = 'REPORT_NUMBER', supplement = 'SUPPLEMENTAL_NUMBER', history = False):
+    """
+    Keep only the latest supplement of every report. \n
+    ---------- \n
+    data : DataFrame \n
+        Annual or incident report data. The report and supplement numbers can
+        be columns or index levels.
+    report : str \n
+        Report number variable.
+    supplement : str \n
+        Supplement number variable.
+    history : bool \n
+        Also return the revision history as a delta table.
+
+    Returns
+    -------
+    latest : DataFrame
+        One row per report, in the original row order.
+    deltas : DataFrame
+        Only if history is True. One row per value that changed between two
+        consecutive supplements: report, supplement, column, previous value
+        and value. Together with latest, it holds every version of the data.
+
+    """
+    reports = _values(data, report)
+    supplements = _values(data, supplement)
+
+    # Sort by report, then supplement; the last row of each report wins
+    order = np.lexsort((supplements, reports))
+    sorted_reports = reports[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = sorted_reports[1:] != sorted_reports[:-1]
+    latest = data.iloc[np.sort(order[last])]
+    if not history:
+        return latest
+
+    # Compare each supplement with the previous one of the same report
+    current = order[1:][sorted_reports[1:] == sorted_reports[:-1]]
+    previous = order[:-1][sorted_reports[1:] == sorted_reports[:-1]]
+    columns = [c for c in data.columns if c not in (report, supplement)]
+    deltas = []
+    for name in columns:
+        values = data[name].to_numpy()
+        changed = ~_same(values[current], values[previous])
+        if changed.any():
+            deltas.append(pd.DataFrame({report: reports[current[changed]],
+                                        supplement: supplements[current[changed]],
+                                        'column': name,
+                                        'previous': values[previous[changed]],
+                                        'value': values[current[changed]]}))
+    if deltas:
+        deltas = pd.concat(deltas, ignore_index=True)
+    else:
+        deltas = pd.DataFrame(columns=[report, supplement, 'column', 'previous', 'value'])
+    deltas['column'] = deltas['column'].astype(pd.CategoricalDtype(columns))
+    deltas = deltas.sort_values([report, supplement], kind='stable', ignore_index=True)
+    return latest, deltas
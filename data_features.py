@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Feature Matrix
+
+The objective of this module is to turn the curated incident data into the
+arrays used by the prediction models, once:
+    X        : contiguous float32 matrix of the numeric and derived features
+    onehot   : sparse float32 one-hot encoding of the categorical features
+    y        : float32 target, LIFE_INSTALLED by default
+
+The arrays of each set of curation parameters are memoized on disk, so the
+models can be trained without going through pandas again.
+"""
+
+import numpy as np
+import data_incident
+import data_memo
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+sparse = data_lazy.lazy_import('scipy.sparse')
+# =============================================================================
+# FEATURE SETTINGS
+# =============================================================================
+
+numeric_features = ['PIPE_DIAMETER',
+                    'PIPE_WALL_THICKNESS',
+                    'PIPE_SMYS',
+                    ]
+categorical_features = ['PIPE_SEAM_TYPE',
+                        'PIPE_COATING_TYPE',
+                        'PIPE_MANUFACTURER',
+                        'PIPE_SPECIFICATION',
+                        ]
+target = 'LIFE_INSTALLED'
+
+# =============================================================================
+# FEATURE BUILDER
+# =============================================================================
+
+def _year(values):
+    # Year of a datetime or numeric year column
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values.dt.year.to_numpy(dtype=np.float64, na_value=np.nan)
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+def build_features(data, numeric = None, categorical = None, target = target):
+    """
+    Build the feature arrays of a curated incident dataset. Missing numeric
+    values are NaN; missing categories are not encoded. Rows without a
+    target are dropped. \n
+    ---------- \n
+    data : DataFrame \n
+        Curated incident data, e.g. data, data_IC or data_EC of
+        data_incident.
+    numeric : list of str \n
+        Numeric features. Defaults to numeric_features.
+    categorical : list of str \n
+        One-hot encoded features. Defaults to categorical_features.
+    target : str \n
+        Target variable.
+
+    Returns
+    -------
+    features : dict
+        X              : ndarray float32 (rows x numeric and derived)
+        names          : list of str, columns of X
+        onehot         : csr_matrix float32 (rows x categories)
+        onehot_names   : list of str, columns of onehot ('VARIABLE=value')
+        y              : ndarray float32
+        operator       : ndarray, OPERATOR_ID of each row (for grouped
+                         cross validation)
+
+    """
+    if numeric is None:
+        numeric = numeric_features
+    if categorical is None:
+        categorical = categorical_features
+    data = data[data[target].notna().to_numpy()]
+    rows = len(data)
+
+    # Numeric and derived engineering features
+    columns = [pd.to_numeric(data[name], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+               for name in numeric]
+    names = list(numeric)
+    if 'PIPE_DIAMETER' in data.columns and 'PIPE_WALL_THICKNESS' in data.columns:
+        diameter = pd.to_numeric(data['PIPE_DIAMETER'], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        thickness = pd.to_numeric(data['PIPE_WALL_THICKNESS'], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns.append(np.where(thickness > 0, diameter / thickness, np.nan))
+        names.append('D_T_RATIO')
+    if 'INSTALLATION_YEAR' in data.columns:
+        columns.append(np.floor(_year(data['INSTALLATION_YEAR']) / 10) * 10)
+        names.append('INSTALLATION_DECADE')
+    X = np.empty((rows, len(columns)), dtype=np.float32)
+    for i, values in enumerate(columns):
+        X[:, i] = values
+
+    # Sparse one-hot encoding, one block per categorical feature
+    blocks = []
+    onehot_names = []
+    for name in categorical:
+        codes, categories = pd.factorize(data[name], sort=True)
+        keep = codes >= 0
+        blocks.append(sparse.csr_matrix((np.ones(keep.sum(), dtype=np.float32),
+                                         (np.flatnonzero(keep), codes[keep])),
+                                        shape=(rows, len(categories))))
+        onehot_names += ['{}={}'.format(name, c) for c in categories]
+    if blocks:
+        onehot = sparse.hstack(blocks, format='csr', dtype=np.float32)
+    else:
+        onehot = sparse.csr_matrix((rows, 0), dtype=np.float32)
+
+    operator = data['OPERATOR_ID'].to_numpy() if 'OPERATOR_ID' in data.columns else None
+    return {'X': X,
+            'names': names,
+            'onehot': onehot,
+            'onehot_names': onehot_names,
+            'y': data[target].to_numpy(dtype=np.float32),
+            'operator': operator}
+
+def design_matrix(features):
+    """
+    Combine the numeric and one-hot features into one sparse matrix. \n
+    ---------- \n
+    features : dict \n
+        Output of build_features.
+
+    Returns
+    -------
+    csr_matrix
+        float32 matrix, numeric columns first.
+
+    """
+    return sparse.hstack([sparse.csr_matrix(features['X']), features['onehot']],
+                         format='csr', dtype=np.float32)
+
+# =============================================================================
+# MEMOIZED FEATURES
+# =============================================================================
+
+def _sources(category, year_bin, **kwargs):
+    return data_incident._sources(category, year_bin)
+
+@data_memo.memoize(_sources)
+def features(category = 'gas_transmission', year_bin = 3, failure_cause = 'corrosion',
+             material = 'carbon_steel', subset = 'all', numeric = None, categorical = None):
+    """
+    Feature arrays of a curated incident dataset, memoized in memory and on
+    disk by the curation parameters and the source workbook. \n
+    ---------- \n
+    category, year_bin, failure_cause, material : \n
+        Same as data_incident.
+    subset : str \n
+        all ~ every curated incident \n
+        IC ~ internal corrosion only \n
+        EC ~ external corrosion only
+    numeric, categorical : list of str \n
+        Same as build_features.
+
+    Returns
+    -------
+    features : dict
+        Same as build_features.
+
+    """
+    results = data_incident.data_incident(category, year_bin, failure_cause, material)
+    data = {'all': results[1], 'IC': results[2], 'EC': results[3]}[subset]
+    return build_features(data, numeric, categorical)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Lifetime Distribution Fitting
+
+The objective of this module is to fit lifetime distributions to the curated
+incident data for every stratum (e.g. data_IC and data_EC split by
+PIPE_DIAMETER, PIPE_SMYS and PIPE_COATING_TYPE), with bootstrap confidence
+intervals.
+
+The maximum likelihood estimates of all the strata are computed together:
+    weibull   : Newton iterations on the profile likelihood of the shape,
+                with the sums of every stratum from one bincount
+    lognormal : closed form from the group sums of log(t)
+A bootstrap resample of every stratum is a single batched fit, and chunks of
+resamples run in a process pool. Each chunk has its own seed spawned from the
+main seed, so the results do not depend on the number of workers.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# FIT SETTINGS
+# =============================================================================
+
+# Newton iterations for the Weibull shape
+newton_iterations = 50
+newton_tolerance = 1e-10
+# Bootstrap resamples per process pool task
+chunk_size = 100
+
+# =============================================================================
+# BATCHED MAXIMUM LIKELIHOOD
+# =============================================================================
+
+def fit_batch(t, code, size):
+    """
+    Weibull and lognormal maximum likelihood estimates of several groups at
+    once. \n
+    ---------- \n
+    t : ndarray \n
+        Positive lifetimes of all the groups.
+    code : ndarray \n
+        Group of each lifetime, 0 to size - 1.
+    size : int \n
+        Number of groups.
+
+    Returns
+    -------
+    dict of ndarray
+        n, weibull_shape, weibull_scale, weibull_loglik, lognorm_mu,
+        lognorm_sigma, lognorm_loglik; one value per group.
+
+    """
+    n = np.bincount(code, minlength=size).astype(np.float64)
+    log_t = np.log(t)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Lognormal: closed form
+        sum_log = np.bincount(code, log_t, size)
+        mu = sum_log / n
+        sigma = np.sqrt(np.bincount(code, (log_t - mu[code]) ** 2, size) / n)
+        lognorm_loglik = -sum_log - n * np.log(sigma) - n / 2 * np.log(2 * np.pi) - n / 2
+
+        # Weibull: the lifetimes are divided by the group maximum, which does
+        # not change the shape and keeps t^k within (0, 1]
+        t_max = np.zeros(size)
+        np.maximum.at(t_max, code, t)
+        t_min = np.full(size, np.inf)
+        np.minimum.at(t_min, code, t)
+        log_x = log_t - np.log(t_max)[code]
+        mean_log = np.bincount(code, log_x, size) / n
+        shape = 1.2825 / np.sqrt(np.bincount(code, (log_x - mean_log[code]) ** 2, size) / n)
+        shape = np.where(np.isfinite(shape), shape, 1.0)
+
+        # Groups with fewer than two distinct lifetimes (a single event, or
+        # small bootstrap resamples) have no finite estimates
+        degenerate = (n < 2) | (t_min == t_max)
+        shape[degenerate] = np.nan
+        mu[degenerate] = np.nan
+        sigma[degenerate] = np.nan
+        lognorm_loglik[degenerate] = np.nan
+
+        # Newton iterations only on the groups that have not converged
+        active = ~degenerate
+        for _ in range(newton_iterations):
+            if not active.any():
+                break
+            rows = active[code]
+            group, log_xa = code[rows], log_x[rows]
+            xk = np.exp(shape[group] * log_xa)
+            s0 = np.bincount(group, xk, size)
+            s1 = np.bincount(group, xk * log_xa, size)
+            s2 = np.bincount(group, xk * log_xa ** 2, size)
+            f = s1 / s0 - 1 / shape - mean_log
+            df = s2 / s0 - (s1 / s0) ** 2 + 1 / shape ** 2
+            step = f / df
+            shape = np.where(active, np.maximum(shape - step, shape / 10), shape)
+            active &= np.abs(step) >= newton_tolerance
+        xk = np.exp(shape[code] * log_x)
+        scale = np.exp(np.log(np.bincount(code, xk, size) / n) / shape) * t_max
+        weibull_loglik = n * np.log(shape) - n * shape * np.log(scale) + \
+            (shape - 1) * sum_log - np.bincount(code, (t / scale[code]) ** shape[code], size)
+
+    return {'n': n,
+            'weibull_shape': shape,
+            'weibull_scale': scale,
+            'weibull_loglik': weibull_loglik,
+            'lognorm_mu': mu,
+            'lognorm_sigma': sigma,
+            'lognorm_loglik': lognorm_loglik}
+
+# =============================================================================
+# BOOTSTRAP
+# =============================================================================
+
+def _bootstrap_chunk(args):
+    # Worker: fit a chunk of resamples, all the strata and resamples at once
+    t, code, size, resamples, seed = args
+    rng = np.random.default_rng(seed)
+    order = np.argsort(code, kind='stable')
+    t, code = t[order], code[order]
+    n = np.bincount(code, minlength=size)
+    start = np.cumsum(n) - n
+    # Resample within each stratum: resample r of stratum s is group r*size+s
+    pick = start[code] + (rng.random((resamples, len(t))) * n[code]).astype(np.intp)
+    groups = (np.arange(resamples)[:, None] * size + code[None, :]).ravel()
+    fits = fit_batch(t[pick.ravel()], groups, resamples * size)
+    return {name: values.reshape(resamples, size) for name, values in fits.items()
+            if name != 'n'}
+
+def bootstrap(t, code, size, resamples = 1000, seed = 0, max_workers = None):
+    """
+    Bootstrap the maximum likelihood estimates of every group. \n
+    ---------- \n
+    t, code, size : \n
+        Same as fit_batch.
+    resamples : int \n
+        Number of bootstrap resamples.
+    seed : int \n
+        Main seed. The seed of each chunk of resamples is spawned from it.
+    max_workers : int \n
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    dict of ndarray
+        The estimates of fit_batch, each of shape (resamples, size).
+
+    """
+    seeds = np.random.SeedSequence(seed).spawn(-(-resamples // chunk_size))
+    tasks = [(t, code, size, min(chunk_size, resamples - i * chunk_size), s)
+             for i, s in enumerate(seeds)]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        chunks = list(pool.map(_bootstrap_chunk, tasks))
+    return {name: np.concatenate([c[name] for c in chunks]) for name in chunks[0]}
+
+# =============================================================================
+# STRATA
+# =============================================================================
+
+def fit_strata(data, by = None, life = 'LIFE_INSTALLED', resamples = 1000, alpha = 0.05,
+               seed = 0, max_workers = None):
+    """
+    Fit the Weibull and lognormal lifetime distributions of every stratum,
+    with bootstrap confidence intervals. \n
+    ---------- \n
+    data : DataFrame \n
+        Curated incident data, e.g. data_IC or data_EC of data_incident.
+    by : list of str \n
+        Variables that define the strata, e.g. ['PIPE_DIAMETER',
+        'PIPE_SMYS', 'PIPE_COATING_TYPE']. If None, a single stratum.
+    life : str \n
+        Lifetime in years. Only positive lifetimes are used.
+    resamples : int \n
+        Number of bootstrap resamples. 0 skips the bootstrap.
+    alpha : float \n
+        The confidence intervals are the alpha/2 and 1 - alpha/2 bootstrap
+        percentiles.
+    seed : int \n
+        Seed of the bootstrap.
+    max_workers : int \n
+        Number of worker processes for the bootstrap.
+
+    Returns
+    -------
+    DataFrame
+        One row per stratum: the stratum keys, n, the estimates of fit_batch
+        and, for each parameter, its _lo and _hi confidence limits.
+
+    """
+    data = data[(data[life] > 0).to_numpy()]
+    t = data[life].to_numpy(dtype=np.float64)
+    if by:
+        code = data.groupby(by, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+        strata = data[by].drop_duplicates().reset_index(drop=True)
+    else:
+        code = np.zeros(len(t), dtype=np.intp)
+        strata = pd.DataFrame(index=[0])
+    size = len(strata)
+
+    result = strata.assign(**fit_batch(t, code, size))
+    result['n'] = result['n'].astype(np.int64)
+    if resamples:
+        boot = bootstrap(t, code, size, resamples, seed, max_workers)
+        for name in ['weibull_shape', 'weibull_scale', 'lognorm_mu', 'lognorm_sigma']:
+            lo, hi = np.nanpercentile(boot[name], [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+            result[name + '_lo'] = lo
+            result[name + '_hi'] = hi
+    return result
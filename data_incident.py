@@ -6,8 +6,16 @@ The objective of this module is to call the datasets, map the variables to
 maintain consistency, and curate the data for future analysis.
 """
 
-import pandas as pd
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import data_cache
+import data_compact
+import data_memo
+import data_lazy
+import data_trace
+pd = data_lazy.lazy_import('pandas')
 # =============================================================================
 # DATA PREPARATION: IMPORT DATA
 # =============================================================================
@@ -109,10 +117,67 @@ df_cols = [# Gas Transmission & Gathering Incident Data
            df_cats[1] + '_2',
            df_cats[1] + '_3']
 
-df = pd.DataFrame(index=df_index)
-df.insert(loc=0, column=df_cols[3], value=var_gt_3)
+_df = None
+
+def mapping():
+    """
+    Variable mapping DataFrame (df). It is built on first use, so importing
+    this module does not import pandas.
+
+    Returns
+    -------
+    DataFrame
+        Source variable names, indexed by df_index, one column per dataset.
+
+    """
+    global _df
+    if _df is None:
+        _df = pd.DataFrame(index=df_index)
+        _df.insert(loc=0, column=df_cols[3], value=var_gt_3)
+    return _df
 
-def data_incident(category = 'gas_transmission', year_bin = 3, failure_cause = 'corrosion', material = 'carbon_steel'):
+def __getattr__(name):
+    # The module attribute df is the lazily built mapping
+    if name == 'df':
+        return mapping()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def mapped_columns(category_bin):
+    """
+    List the source columns of a dataset that are mapped in df. \n
+    ---------- \n
+    category_bin : str \n
+        Column of df, e.g. gas_transmission_3
+
+    Returns
+    -------
+    list of str
+        Source column names, without the file name.
+
+    """
+    return list(mapping()[category_bin].drop('File Name').dropna())
+
+def file_path(category_bin):
+    """
+    Path to the PHMSA workbook of a dataset. \n
+    ---------- \n
+    category_bin : str \n
+        Column of df, e.g. gas_transmission_3
+
+    Returns
+    -------
+    str
+        Path to the workbook.
+
+    """
+    return os.path.join(path, mapping().loc['File Name', category_bin])
+
+def _sources(category, year_bin, **kwargs):
+    return [file_path(category + '_' + str(year_bin))]
+
+@data_memo.memoize(_sources)
+def data_incident(category = 'gas_transmission', year_bin = 3, failure_cause = 'corrosion', material = 'carbon_steel',
+                  extra_columns = None, compact = False):
     """
     Select the PHMSA dataset and year bin. Data curation will be performed
     according to the method selected. \n
@@ -129,70 +194,261 @@ def data_incident(category = 'gas_transmission', year_bin = 3, failure_cause = '
         2 ~ 2002-2009 \n
         3 ~ 2010-present
     failure_cause : str \n
-        corrosion
+        corrosion \n
+        all (together with material = all)
     material : str \n
         carbon_steel \n
-        plastic
+        plastic \n
+        all (together with failure_cause = all)
+    extra_columns : list of str or 'all' \n
+        Only the mapped columns are read by default. Unmapped source columns
+        must be requested here, or 'all' to read the whole workbook.
+    compact : bool \n
+        Convert the data to compact dtypes (see data_compact). The bytes
+        saved per column are stored in data.attrs['bytes_saved'].
 
     Returns
     -------
-    None.
+    df : DataFrame
+        Variable mapping.
+    data : DataFrame
+        Curated data.
+    data_IC, data_EC : DataFrame
+        For corrosion of carbon steel: internal and external corrosion.
+    partitions : dict
+        For failure_cause = material = all: row positions in data for each
+        (CAUSE, CAUSE_DETAILS, MATERIAL_INVOLVED), see partition().
 
     """
     # Import the PHMSA dataset
     category_bin = category + '_' + str(year_bin)
-    file_path = path + '\\' + df.loc['File Name', category_bin]
-    data = pd.read_excel(file_path)
+    if extra_columns == 'all':
+        columns = None
+    else:
+        columns = mapped_columns(category_bin) + list(extra_columns or [])
+    with data_trace.stage('read', category_bin) as stage:
+        data = data_cache.read_excel(file_path(category_bin), columns=columns)
+        stage.rows(data)
+    if compact:
+        with data_trace.stage('compact', category_bin, data) as stage:
+            data, saved = data_compact.compact(data)
+            data.attrs['bytes_saved'] = saved['saved'].to_dict()
+            stage.rows(data)
     
     # Begin curating the data
+    if failure_cause == 'all' and material == 'all':
+        # Every (CAUSE, CAUSE_DETAILS, MATERIAL_INVOLVED) subset at once
+        data, partitions = partition(data, category_bin)
+        return mapping(), data, partitions
     if category == 'gas_transmission':
         if (failure_cause == 'corrosion' and material == 'carbon_steel'):
             # This will only focus on the following: 
             #   Apparent Cause      = Corrosion Failure
             #   Material Involved   = Carbon Steel
+            data, data_IC, data_EC = curate(data, category_bin,
+                                            flag_material='CARBON STEEL',
+                                            flag_cause='CORROSION FAILURE')
             
-            # Drop all the data that is not MATERIAL_INVOLVED = CARBON STEEL
-            flag1 = 'CARBON STEEL'
-            flagged_data = data[data[df.loc['Material', category_bin]] != flag1].index
-            data.drop(flagged_data, inplace=True)
-            
-            # Drop all the data that does not have an INSTALLATION_YEAR or MANUFACTURED_YEAR
-            flag2 = np.nan
-            flagged_data = data[data[df.loc['Installation Year', category_bin]] == flag2].index
-            data.drop(flagged_data, inplace=True)
-            flagged_data = data[data[df.loc['Manufactured Year', category_bin]] == flag2].index
-            data.drop(flagged_data, inplace=True)
-            
-            # Convert the INSTALLATION_YEAR and MANUFACTURED_YEAR data into datetime64[ns]
-            data[df.loc['Installation Year', category_bin]] = \
-                pd.to_datetime(data[df.loc['Installation Year', category_bin]], format='%Y', errors='coerce')
-            data[df.loc['Manufactured Year', category_bin]] = \
-                pd.to_datetime(data[df.loc['Manufactured Year', category_bin]], format='%Y', errors='coerce')
-            
-            # Insert new column with LIFETIME data
-            life_install = data[df.loc['Incident Date', category_bin]] - \
-                data[df.loc['Installation Year', category_bin]]
-            data.insert(0, 'LIFE_INSTALLED', (life_install.astype('timedelta64[D]')/365.25), allow_duplicates=True)
-            life_manufac = data[df.loc['Incident Date', category_bin]] - \
-                data[df.loc['Manufactured Year', category_bin]]
-            data.insert(0, 'LIFE_MANUFACTURED', (life_manufac.astype('timedelta64[D]')/365.25), allow_duplicates=True)
-            
-            # Drop all the data that is not CAUSE = CORROSION FAILURE
-            flag3 = 'CORROSION FAILURE'
-            flagged_data = data[data[df.loc['Failure Cause', category_bin]] != flag3].index
-            data.drop(flagged_data, inplace=True)
-            
-            # Separate the data into External Corrosion and Internal Corrosion
-            flag_IC = 'INTERNAL CORROSION'
-            flag_EC = 'EXTERNAL CORROSION'
-            data_IC = data[data[df.loc['Failure Cause Details', category_bin]] == flag_IC]
-            data_EC = data[data[df.loc['Failure Cause Details', category_bin]] == flag_EC]
-            
-            return df, data, data_IC, data_EC
+            return mapping(), data, data_IC, data_EC
     else:
-        return df, data
+        return mapping(), data
+
+# =============================================================================
+# DATA PREPARATION: ALL YEAR BINS
+# =============================================================================
+
+def _harmonize(data, category_bin, reference_bin):
+    # Rename the era specific variables to the names of the reference era
+    names = mapping()[category_bin].drop('File Name')
+    reference = mapping()[reference_bin].drop('File Name')
+    rename = {old: reference[key] for key, old in names.dropna().items()
+              if pd.notna(reference[key]) and old != reference[key]}
+    return data.rename(columns=rename)
+
+def _data_incident_era(args):
+    # Worker: load, map and curate a single year bin
+    category, year_bin, failure_cause, material, reference_bin = args
+    category_bin = category + '_' + str(year_bin)
+    results = data_incident(category, year_bin, failure_cause, material)[1:]
+    frames = []
+    for data in results:
+        if isinstance(data, dict):
+            # Partitions are rebuilt on the concatenated data
+            continue
+        data = _harmonize(data, category_bin, reference_bin)
+        data.insert(0, 'ERA', year_bin)
+        frames.append(data)
+    return frames
+
+def data_incident_all(category = 'gas_transmission', year_bins = None, failure_cause = 'corrosion',
+                      material = 'carbon_steel', max_workers = None):
+    """
+    Load, map and curate several year bins concurrently, one worker process
+    per workbook, and concatenate them into a single dataset. Only the year
+    bins with a variable mapping in df can be loaded; today that is year bin
+    3 (2010-present) of gas_transmission. The historical workbooks can be
+    read with data_stream. \n
+    ---------- \n
+    category : str \n
+        Same as data_incident.
+    year_bins : list of int \n
+        Year bins to load. If None, every year bin of the category that has
+        a variable mapping in df is loaded. Year bins without a mapping
+        raise a ValueError.
+    failure_cause : str \n
+        Same as data_incident.
+    material : str \n
+        Same as data_incident.
+    max_workers : int \n
+        Number of worker processes. Defaults to one per year bin.
+
+    Returns
+    -------
+    df : DataFrame
+        Variable mapping.
+    data : DataFrame
+        All year bins, with the variable names of the most recent year bin
+        and an ERA column with the year bin of each row.
+    data_IC, data_EC : DataFrame
+        Only for corrosion of carbon steel, same as data_incident.
+    partitions : dict
+        Only for failure_cause = material = all, same as data_incident.
+
+    """
+    mapped = sorted(int(col.rsplit('_', 1)[1]) for col in mapping().columns
+                    if col.startswith(category + '_'))
+    if year_bins is None:
+        year_bins = mapped
+    year_bins = list(year_bins)
+    if not year_bins:
+        raise ValueError('No year bins to load for {} (mapped year bins: {})'.format(category,
+                                                                                    mapped))
+    unmapped = [year_bin for year_bin in year_bins if year_bin not in mapped]
+    if unmapped:
+        raise ValueError('Year bins {} of {} have no variable mapping in df; the supported year '
+                         'bins are {}. Use data_stream for the historical workbooks.'
+                         .format(unmapped, category, mapped))
+    reference_bin = category + '_' + str(max(year_bins))
+
+    # Each worker parses its own workbook, so the wall time is set by the
+    # slowest file
+    tasks = [(category, year_bin, failure_cause, material, reference_bin)
+             for year_bin in year_bins]
+    with ProcessPoolExecutor(max_workers=max_workers or len(tasks)) as pool:
+        eras = list(pool.map(_data_incident_era, tasks))
+
+    results = [pd.concat(frames, ignore_index=True) for frames in zip(*eras)]
+    if failure_cause == 'all' and material == 'all':
+        var = mapping()[reference_bin]
+        keys = [var['Failure Cause'], var['Failure Cause Details'], var['Material']]
+        partitions = results[0].groupby(keys, sort=False, dropna=False, observed=True).indices
+        results.append(partitions)
+    return (mapping(), *results)
 
 # =============================================================================
 # DATA PREPARATION: CURATE DATA
 # =============================================================================
 
+def _lifetimes(data, var):
+    # Convert the INSTALLATION_YEAR and MANUFACTURED_YEAR data into datetime
+    installed = pd.to_datetime(data[var['Installation Year']], format='%Y', errors='coerce')
+    manufactured = pd.to_datetime(data[var['Manufactured Year']], format='%Y', errors='coerce')
+    incident = pd.to_datetime(data[var['Incident Date']], errors='coerce')
+    data = data.assign(**{var['Installation Year']: installed,
+                          var['Manufactured Year']: manufactured})
+    
+    # Insert new columns with LIFETIME data in years
+    data.insert(0, 'LIFE_INSTALLED', (incident - installed).dt.days / 365.25,
+                allow_duplicates=True)
+    data.insert(0, 'LIFE_MANUFACTURED', (incident - manufactured).dt.days / 365.25,
+                allow_duplicates=True)
+    return data
+
+def curate(data, category_bin, flag_material = 'CARBON STEEL', flag_cause = 'CORROSION FAILURE'):
+    """
+    Curate an incident dataset in a single pass. All the filters are combined
+    into one boolean mask, which is applied once; the lifetimes are only
+    computed for the rows that survive. \n
+    ---------- \n
+    data : DataFrame \n
+        Incident data as read from the PHMSA workbook.
+    category_bin : str \n
+        Column of df with the variable mapping of data.
+    flag_material : str \n
+        Keep the rows with this MATERIAL_INVOLVED.
+    flag_cause : str \n
+        Keep the rows with this CAUSE.
+
+    Returns
+    -------
+    data : DataFrame
+        Curated data with the LIFE_MANUFACTURED and LIFE_INSTALLED columns.
+    data_IC : DataFrame
+        Rows with CAUSE_DETAILS = INTERNAL CORROSION.
+    data_EC : DataFrame
+        Rows with CAUSE_DETAILS = EXTERNAL CORROSION.
+
+    """
+    var = mapping()[category_bin]
+    
+    # Keep MATERIAL_INVOLVED = flag_material and CAUSE = flag_cause, and drop
+    # all the data that does not have an INSTALLATION_YEAR or MANUFACTURED_YEAR.
+    # Each filter is a stage of the trace, but the mask is applied only once
+    with data_trace.stage('material_filter', category_bin, data) as stage:
+        mask = data[var['Material']] == flag_material
+        stage.rows(mask)
+    with data_trace.stage('year_filter', category_bin, mask) as stage:
+        mask &= data[var['Installation Year']].notna() & \
+            data[var['Manufactured Year']].notna()
+        stage.rows(mask)
+    with data_trace.stage('cause_filter', category_bin, mask) as stage:
+        mask &= data[var['Failure Cause']] == flag_cause
+        data = data.loc[mask.to_numpy()]
+        stage.rows(data)
+    
+    with data_trace.stage('datetime_conversion', category_bin, data) as stage:
+        data = _lifetimes(data, var)
+        stage.rows(data)
+    
+    # Separate the data into External Corrosion and Internal Corrosion with
+    # a single grouping of the CAUSE_DETAILS
+    with data_trace.stage('split', category_bin, data) as stage:
+        groups = data.groupby(var['Failure Cause Details'], sort=False, observed=True).indices
+        empty = np.array([], dtype=np.intp)
+        data_IC = data.iloc[groups.get('INTERNAL CORROSION', empty)]
+        data_EC = data.iloc[groups.get('EXTERNAL CORROSION', empty)]
+        stage.rows(len(data_IC) + len(data_EC))
+    
+    return data, data_IC, data_EC
+
+def partition(data, category_bin):
+    """
+    Partition an incident dataset by every combination of CAUSE,
+    CAUSE_DETAILS and MATERIAL_INVOLVED with a single groupby. The lifetimes
+    are computed once for all the rows; rows without an installation or
+    manufacture year keep a NaN lifetime. \n
+    ---------- \n
+    data : DataFrame \n
+        Incident data as read from the PHMSA workbook.
+    category_bin : str \n
+        Column of df with the variable mapping of data.
+
+    Returns
+    -------
+    data : DataFrame
+        All rows with the LIFE_MANUFACTURED and LIFE_INSTALLED columns.
+    partitions : dict
+        Row positions in data for each (CAUSE, CAUSE_DETAILS,
+        MATERIAL_INVOLVED) key. Use data.iloc[partitions[key]] to get a
+        subset; no subset is copied until it is requested.
+
+    """
+    var = mapping()[category_bin]
+    with data_trace.stage('datetime_conversion', category_bin, data) as stage:
+        data = _lifetimes(data, var)
+        stage.rows(data)
+    with data_trace.stage('partition', category_bin, data) as stage:
+        keys = [var['Failure Cause'], var['Failure Cause Details'], var['Material']]
+        partitions = data.groupby(keys, sort=False, dropna=False, observed=True).indices
+        stage.rows(data)
+    return data, partitions
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy Imports
+
+The objective of this module is to keep the import of the PHMSA modules
+fast. Heavy dependencies (pandas, matplotlib, scipy, sklearn) are bound to a
+placeholder at import time and only imported on the first attribute access,
+e.g. pd.DataFrame. Short-lived worker processes and headless data jobs then
+only pay for the libraries they actually use.
+"""
+
+import importlib
+import sys
+# =============================================================================
+# LAZY MODULE
+# =============================================================================
+
+class LazyModule:
+    """
+    Placeholder of a module that is imported on first attribute access. \n
+    ---------- \n
+    name : str \n
+        Full name of the module, e.g. 'pandas' or 'matplotlib.pyplot'.
+
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module {!r} ({})>'.format(self._name, state)
+
+def lazy_import(name):
+    """
+    Module placeholder, imported on first use. If the module is already
+    imported, the module itself is returned. \n
+    ---------- \n
+    name : str \n
+        Full name of the module.
+
+    Returns
+    -------
+    module or LazyModule
+
+    """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+def loaded(module):
+    """
+    Check if a module returned by lazy_import has been imported. \n
+    ---------- \n
+    module : module or LazyModule \n
+        Output of lazy_import.
+
+    Returns
+    -------
+    bool
+
+    """
+    return not isinstance(module, LazyModule) or module._module is not None
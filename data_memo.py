@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Memoized Results
+
+The objective of this module is to return repeated data_incident and
+data_report calls without reading or curating the data again. Results are
+keyed by the call arguments and the fingerprint (size and mtime) of the
+source workbooks, and kept in two tiers:
+    memory : LRU limited by a byte budget
+    disk   : pickles in the cache directory
+
+The returned objects are shared with the cache, so they must not be modified
+in place.
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+import data_cache
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# MEMO SETTINGS
+# =============================================================================
+
+# Maximum size of the in-memory tier, in bytes
+memory_budget = 512 * 2**20
+# Set to False to always call the functions
+memo_enabled = True
+# Set to False to keep only the in-memory tier
+disk_enabled = True
+
+_memory = OrderedDict()
+_memory_bytes = 0
+_stats = {'hits': 0,
+          'disk_hits': 0,
+          'misses': 0,
+          'evictions': 0}
+
+# =============================================================================
+# RESULT SIZE
+# =============================================================================
+
+def nbytes(value):
+    """
+    Estimate the memory used by a result. \n
+    ---------- \n
+    value : object \n
+        DataFrame, Series, array, a tuple/list/dict of them, or an object
+        holding them as attributes.
+
+    Returns
+    -------
+    int
+        Size in bytes.
+
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(nbytes(k) + nbytes(v) for k, v in value.items())
+    if hasattr(value, '__dict__'):
+        return nbytes(vars(value))
+    return 64
+
+# =============================================================================
+# CACHE TIERS
+# =============================================================================
+
+def _disk_path(name, key):
+    return os.path.join(data_cache.cache_dir, 'memo', '{}.{}.pkl'.format(name, key))
+
+def _memory_put(key, value):
+    global _memory_bytes
+    size = nbytes(value)
+    if size > memory_budget:
+        return
+    _memory[key] = (value, size)
+    _memory_bytes += size
+    # Evict the least recently used results until the budget is met
+    while _memory_bytes > memory_budget:
+        _, (_, evicted) = _memory.popitem(last=False)
+        _memory_bytes -= evicted
+        _stats['evictions'] += 1
+
+def stats():
+    """
+    Cache counters, to size the memory budget. \n
+    ---------- \n
+
+    Returns
+    -------
+    dict
+        hits, disk_hits, misses, evictions, entries and bytes of the memory
+        tier, and the memory budget.
+
+    """
+    return dict(_stats, entries=len(_memory), bytes=_memory_bytes,
+                budget=memory_budget)
+
+def clear(disk=False):
+    """
+    Empty the memory tier and reset the counters. \n
+    ---------- \n
+    disk : bool \n
+        Also remove the disk tier.
+
+    Returns
+    -------
+    None.
+
+    """
+    global _memory_bytes
+    _memory.clear()
+    _memory_bytes = 0
+    for counter in _stats:
+        _stats[counter] = 0
+    folder = os.path.join(data_cache.cache_dir, 'memo')
+    if disk and os.path.isdir(folder):
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+
+# =============================================================================
+# MEMOIZE DECORATOR
+# =============================================================================
+
+def _source_fingerprint(paths):
+    fingerprint = []
+    for file_path in paths:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        fingerprint.append((os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns))
+    return fingerprint
+
+def memoize(sources, ignore = ()):
+    """
+    Memoize a data loading function. \n
+    ---------- \n
+    sources : callable \n
+        Called with the same arguments as the function, returns the list of
+        source files the result depends on.
+    ignore : list of str \n
+        Arguments left out of the key because they do not change the result,
+        e.g. the number of worker processes.
+
+    Returns
+    -------
+    decorator
+        Wraps the function with the memory and disk tiers.
+
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not memo_enabled:
+                return func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            fingerprint = _source_fingerprint(sources(**bound.arguments))
+            if fingerprint is None:
+                # Missing source: let the function raise its own error
+                return func(*args, **kwargs)
+
+            arguments = [(name, value) for name, value in bound.arguments.items()
+                         if name not in ignore]
+            call = (func.__module__, func.__qualname__, sorted(arguments), fingerprint)
+            key = hashlib.sha1(repr(call).encode('utf-8')).hexdigest()
+
+            # Memory tier
+            if key in _memory:
+                _memory.move_to_end(key)
+                _stats['hits'] += 1
+                return _memory[key][0]
+
+            # Disk tier
+            disk_path = _disk_path(func.__name__, key)
+            if disk_enabled and os.path.exists(disk_path):
+                with open(disk_path, 'rb') as f:
+                    value = pickle.load(f)
+                _stats['disk_hits'] += 1
+                _memory_put(key, value)
+                return value
+
+            _stats['misses'] += 1
+            value = func(*args, **kwargs)
+            _memory_put(key, value)
+            if disk_enabled:
+                os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+                with open(disk_path, 'wb') as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            return value
+
+        return wrapper
+    return decorator
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+Batch Jobs
+
+The objective of this module is to run the whole analysis for a job spec:
+every combination of category, era, cause and material goes through the
+stages
+    load -> curate -> fit, plot
+    load + annual  -> incident rates
+The stages form a dependency graph. Stages whose inputs are ready run
+concurrently in a process pool and exchange their results through files in
+the output folder.
+
+Every stage output has a manifest with the key of its inputs: the stage
+parameters, the fingerprint of the source workbooks and the content digest of
+the upstream outputs. A stage whose key has not changed is skipped, so a
+rerun only recomputes what depends on a changed workbook or setting.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import data_annual
+import data_cache
+import data_incident
+import data_lazy
+import data_memo
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# JOB SETTINGS
+# =============================================================================
+
+# Job spec names of the PHMSA apparent causes (CAUSE)
+cause_flags = {'corrosion': 'CORROSION FAILURE',
+               'excavation_damage': 'EXCAVATION DAMAGE',
+               'incorrect_operation': 'INCORRECT OPERATION',
+               'material_failure': 'MATERIAL FAILURE OF PIPE OR WELD',
+               'equipment_failure': 'EQUIPMENT FAILURE',
+               'natural_force_damage': 'NATURAL FORCE DAMAGE',
+               'other_outside_force_damage': 'OTHER OUTSIDE FORCE DAMAGE',
+               'other': 'ALL OTHER CAUSES',
+               }
+# Job spec names of the materials (MATERIAL_INVOLVED)
+material_flags = {'carbon_steel': 'CARBON STEEL',
+                  'plastic': 'PLASTIC',
+                  }
+# Annual report year bin joined to each incident era
+annual_bins = {3: 2}
+
+# Default job: the 2010-present corrosion of carbon steel
+default_spec = {'categories': ['gas_transmission'],
+                'eras': [3],
+                'causes': ['corrosion'],
+                'materials': ['carbon_steel'],
+                'operators': None,
+                'fit': {'by': None, 'resamples': 1000, 'seed': 0},
+                'plots': ['hist', 'scatter_matrix'],
+                'output': 'results',
+                }
+
+# =============================================================================
+# STAGES
+# =============================================================================
+# Each stage runs in a worker process: it reads the outputs of its
+# dependencies and writes its own output, a pickle of a dict
+
+def _read(file_path):
+    with open(file_path, 'rb') as f:
+        return pickle.load(f)
+
+def _write(value, file_path):
+    with open(file_path + '.tmp', 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file_path + '.tmp', file_path)
+
+def _stage_load(params, inputs, output):
+    # Mapped columns of an incident workbook, plus the report keys
+    category_bin = params['category_bin']
+    columns = data_incident.mapped_columns(category_bin) + data_annual.report_keys
+    data = data_cache.read_excel(data_incident.file_path(category_bin), columns=columns)
+    _write({'data': data}, output)
+
+def _operators(data, params):
+    if params['operators'] is None:
+        return data
+    return data[data['OPERATOR_ID'].isin(params['operators']).to_numpy()]
+
+def _stage_curate(params, inputs, output):
+    data = _operators(_read(inputs['load'])['data'], params)
+    if params['cause'] == 'all' and params['material'] == 'all':
+        data, partitions = data_incident.partition(data, params['category_bin'])
+        _write({'data': data, 'partitions': partitions}, output)
+    else:
+        data, data_IC, data_EC = data_incident.curate(data, params['category_bin'],
+                                                      flag_material=material_flags[params['material']],
+                                                      flag_cause=cause_flags[params['cause']])
+        _write({'data': data, 'data_IC': data_IC, 'data_EC': data_EC}, output)
+
+def _stage_annual(params, inputs, output):
+    # Parts A to D, latest supplement of every report
+    _, data, _ = data_annual.data_report(params['category'], params['year_bin'],
+                                         operator_id=params['operators'], latest=True)
+    _write({'data': data}, output)
+
+def counted_incidents(data, category_bin, cause = 'corrosion', material = 'carbon_steel'):
+    """
+    Incidents counted by the rates of a cause and material: every loaded
+    incident of the cause and material, not only the curated ones with known
+    installation and manufacture years. \n
+    ---------- \n
+    data : DataFrame \n
+        Mapped columns of the incident workbook (output of the load stage).
+    category_bin : str \n
+        Incident dataset of data, e.g. 'gas_transmission_3'.
+    cause : str \n
+        Name in cause_flags, or 'all' to keep every incident.
+    material : str \n
+        Name in material_flags. Ignored when cause is 'all'.
+
+    Returns
+    -------
+    DataFrame
+        Rows of data with the cause and material.
+
+    """
+    if cause == 'all':
+        return data
+    var = data_incident.mapping()[category_bin]
+    mask = (data[var['Failure Cause']] == cause_flags[cause]) & \
+        (data[var['Material']] == material_flags[material])
+    return data[mask.to_numpy()]
+
+def _stage_rates(params, inputs, output):
+    import data_rate
+    incidents = counted_incidents(_operators(_read(inputs['load'])['data'], params),
+                                  params['category_bin'], params['cause'], params['material'])
+    annual = _read(inputs['annual'])['data']
+    rates = data_rate.incident_rates(incidents, annual, latest=False)
+    frame = data_rate.rates_frame(rates)
+    frame.to_csv(os.path.splitext(output)[0] + '.csv', index=False)
+    _write({'rates': rates, 'frame': frame}, output)
+
+def _stage_fit(params, inputs, output):
+    import data_fit
+    curated = _read(inputs['curate'])
+    fits = []
+    for subset in ['data', 'data_IC', 'data_EC']:
+        data = curated.get(subset)
+        if data is None or not (data['LIFE_INSTALLED'] > 0).any():
+            continue
+        fit = data_fit.fit_strata(data, by=params['by'], resamples=params['resamples'],
+                                  seed=params['seed'], max_workers=1)
+        fits.append(fit.assign(subset=subset))
+    fits = pd.concat(fits, ignore_index=True) if fits else pd.DataFrame()
+    fits.to_csv(os.path.splitext(output)[0] + '.csv', index=False)
+    _write({'fit': fits}, output)
+
+def _stage_plot(params, inputs, output):
+    import results_plot
+    data = _read(inputs['curate'])['data']
+    image = os.path.splitext(output)[0] + '.png'
+    results_plot.render({'plot': params['plot'],
+                         'data': data,
+                         'df': data_incident.mapping(),
+                         'path': image})
+    _write({'path': image}, output)
+
+stages = {'load': _stage_load,
+          'curate': _stage_curate,
+          'annual': _stage_annual,
+          'rates': _stage_rates,
+          'fit': _stage_fit,
+          'plot': _stage_plot,
+          }
+
+# =============================================================================
+# DEPENDENCY GRAPH
+# =============================================================================
+
+def _operators_tag(operators):
+    if operators is None:
+        return 'all'
+    return 'op' + hashlib.sha1(repr(sorted(operators)).encode('utf-8')).hexdigest()[:8]
+
+def build_graph(spec):
+    """
+    Dependency graph of the stages of a job spec. \n
+    ---------- \n
+    spec : dict \n
+        categories : list of str, same as data_incident \n
+        eras       : list of int, incident year bins \n
+        causes     : list of str, names in cause_flags, or all \n
+        materials  : list of str, names in material_flags, or all; every
+                     cause is paired with every material, and all only
+                     with all \n
+        operators  : list of int, OPIDs to keep (optional, all) \n
+        fit        : dict, by, resamples and seed of data_fit.fit_strata
+                     (optional, no fit if None) \n
+        plots      : list of str, plot names in results_plot.plots \n
+        output     : str, output folder \n
+        Missing keys take the value of default_spec.
+
+    Returns
+    -------
+    graph : dict
+        Stage name: kind (key of stages), params, deps (stage names by
+        role), sources (workbooks read) and output (pickle path).
+
+    """
+    spec = dict(default_spec, **spec)
+    output = spec['output']
+    operators = sorted(spec['operators']) if spec['operators'] is not None else None
+    tag = _operators_tag(operators)
+    graph = {}
+
+    def add(kind, name, params, deps = None, sources = None):
+        graph[name] = {'kind': kind,
+                       'params': params,
+                       'deps': deps or {},
+                       'sources': sources or [],
+                       'output': os.path.join(output, kind, name.split(':', 1)[1].replace(':', '.') + '.pkl')}
+        return name
+
+    for category in spec['categories']:
+        for era in spec['eras']:
+            category_bin = category + '_' + str(era)
+            if category_bin not in data_incident.mapping().columns:
+                raise ValueError('No variable mapping for {}'.format(category_bin))
+            load = add('load', 'load:' + category_bin, {'category_bin': category_bin},
+                       sources=[data_incident.file_path(category_bin)])
+            annual = None
+            if era in annual_bins:
+                annual_bin = category + '_' + str(annual_bins[era])
+                annual = add('annual', 'annual:{}:{}'.format(annual_bin, tag),
+                             {'category': category, 'year_bin': annual_bins[era], 'operators': operators},
+                             sources=[data_annual.file_path(annual_bin)])
+
+            for cause in spec['causes']:
+                for material in spec['materials']:
+                    if (cause == 'all') != (material == 'all'):
+                        # all only pairs with all (data_incident.partition)
+                        continue
+                    if cause != 'all' and (cause not in cause_flags or material not in material_flags):
+                        raise ValueError('Unknown cause or material: {}, {}'.format(cause, material))
+                    combo = '{}:{}:{}:{}'.format(category_bin, cause, material, tag)
+                    params = {'category_bin': category_bin, 'cause': cause,
+                              'material': material, 'operators': operators}
+                    curate = add('curate', 'curate:' + combo, params, {'load': load})
+                    if annual is not None:
+                        add('rates', 'rates:' + combo, params, {'load': load, 'annual': annual})
+                    if spec['fit'] is not None:
+                        add('fit', 'fit:' + combo, dict(spec['fit']), {'curate': curate})
+                    for plot in spec['plots']:
+                        add('plot', 'plot:{}:{}'.format(combo, plot), {'plot': plot},
+                            {'curate': curate})
+    return graph
+
+# =============================================================================
+# SCHEDULER
+# =============================================================================
+
+def _manifest(stage):
+    try:
+        with open(stage['output'] + '.json', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _stage_key(stage, digests):
+    # Parameters, source workbook fingerprints and upstream output digests
+    key = {'kind': stage['kind'],
+           'params': stage['params'],
+           'sources': data_memo._source_fingerprint(stage['sources']),
+           'inputs': {role: digests[name] for role, name in sorted(stage['deps'].items())}}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _run_stage(args):
+    # Worker: run one stage and time it
+    kind, params, inputs, output = args
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    stages[kind](params, inputs, output)
+    return time.perf_counter() - start
+
+def run(graph, max_workers = None, force = False, dry_run = False):
+    """
+    Run the stages of a graph, each one as soon as its dependencies are
+    done. Stages with a valid output are skipped. \n
+    ---------- \n
+    graph : dict \n
+        Output of build_graph.
+    max_workers : int \n
+        Number of worker processes. Defaults to the number of CPUs.
+    force : bool \n
+        Run every stage, even with a valid output.
+    dry_run : bool \n
+        Only report which stages would run; a stage after one that would
+        run is reported as pending.
+
+    Returns
+    -------
+    DataFrame
+        One row per stage, in completion order: stage, status (ran,
+        skipped, failed, blocked, or for a dry run: run, pending) and
+        seconds.
+
+    """
+    digests = {}
+    report = []
+    pending = dict(graph)
+    running = {}
+    pool = None if dry_run else ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        while pending or running:
+            # Start or skip every stage whose dependencies are done
+            progress = False
+            for name, stage in list(pending.items()):
+                deps = stage['deps'].values()
+                if any(dep in digests and digests[dep] is None for dep in deps):
+                    # A dependency failed, or would run in a dry run
+                    digests[name] = None
+                    report.append({'stage': name, 'status': 'pending' if dry_run else 'blocked',
+                                   'seconds': 0.0})
+                    del pending[name]
+                    progress = True
+                    continue
+                if any(dep not in digests for dep in deps):
+                    continue
+                del pending[name]
+                progress = True
+                key = _stage_key(stage, digests)
+                manifest = _manifest(stage)
+                if not force and manifest is not None and manifest['key'] == key and \
+                        os.path.exists(stage['output']):
+                    digests[name] = manifest['digest']
+                    report.append({'stage': name, 'status': 'skipped', 'seconds': 0.0})
+                elif dry_run:
+                    digests[name] = None
+                    report.append({'stage': name, 'status': 'run', 'seconds': 0.0})
+                else:
+                    inputs = {role: graph[dep]['output'] for role, dep in stage['deps'].items()}
+                    future = pool.submit(_run_stage, (stage['kind'], stage['params'], inputs,
+                                                      stage['output']))
+                    running[future] = (name, key)
+            if progress and not running:
+                continue
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, key = running.pop(future)
+                stage = graph[name]
+                try:
+                    seconds = future.result()
+                except Exception as error:
+                    digests[name] = None
+                    report.append({'stage': name, 'status': 'failed', 'seconds': 0.0,
+                                   'error': repr(error)})
+                    continue
+                digests[name] = data_cache.file_hash(stage['output'])
+                with open(stage['output'] + '.json', 'w') as f:
+                    json.dump({'key': key, 'digest': digests[name]}, f, indent=1)
+                report.append({'stage': name, 'status': 'ran', 'seconds': seconds})
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return pd.DataFrame(report, columns=['stage', 'status', 'seconds', 'error'])
+
+def run_job(spec, max_workers = None, force = False, dry_run = False):
+    """
+    Build the graph of a job spec and run it. \n
+    ---------- \n
+    spec : dict or str \n
+        Job spec (see build_graph) or path to a JSON file with it.
+    max_workers, force, dry_run : \n
+        Same as run.
+
+    Returns
+    -------
+    DataFrame
+        Same as run.
+
+    """
+    if isinstance(spec, str):
+        with open(spec, 'r') as f:
+            spec = json.load(f)
+    return run(build_graph(spec), max_workers, force, dry_run)
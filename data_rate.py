@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Incident Rates
+
+The objective of this module is to normalize the number of incidents by the
+miles of pipe operated, i.e. incidents per 1,000 miles per year. The incident
+data (data_incident) is joined to the annual report mileage (data_report) by
+operator and report year.
+
+Both sides are reduced to (operator x year) matrices that share the same
+axes, so the rates of every operator, year and class are a single array
+division.
+"""
+
+import numpy as np
+import data_dedupe
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# RATE SETTINGS
+# =============================================================================
+
+# Rate classes: incident filter (column, value) and Part D exposure columns.
+# The incident data counts both transmission and gathering incidents, so the
+# exposure is the Part D total of transmission and gathering miles (PARTD*TOTAL),
+# not the transmission only subtotal (PARTDT*TOTAL)
+rate_classes = {'all': (None,
+                        ['PARTDTOTAL']),
+                'carbon_steel': (('MATERIAL_INVOLVED', 'CARBON STEEL'),
+                                 ['PARTDCPBTOTAL', 'PARTDCPCTOTAL',
+                                  'PARTDCUBTOTAL', 'PARTDCUCTOTAL']),
+                'plastic': (('MATERIAL_INVOLVED', 'PLASTIC'),
+                            ['PARTDPTOTAL']),
+                }
+# Exposure only classes. The incident data does not record the corrosion
+# prevention status, so these are reported as mileage, not as rates
+exposure_classes = {'steel_cp_bare': ['PARTDCPBTOTAL'],
+                    'steel_cp_coated': ['PARTDCPCTOTAL'],
+                    'steel_unprotected_bare': ['PARTDCUBTOTAL'],
+                    'steel_unprotected_coated': ['PARTDCUCTOTAL'],
+                    }
+# Rates are given per this many miles
+per_miles = 1000
+
+# =============================================================================
+# OPERATOR x YEAR MATRICES
+# =============================================================================
+
+def _accumulate(rows, cols, weights, shape, sparse):
+    # Sum the weights of each (row, col) cell in a single pass
+    if sparse:
+        from scipy import sparse as sp
+        if weights is None:
+            weights = np.ones(len(rows))
+        return sp.coo_matrix((weights, (rows, cols)), shape=shape).tocsr()
+    flat = np.bincount(rows * shape[1] + cols, weights=weights,
+                       minlength=shape[0] * shape[1])
+    return flat.reshape(shape).astype(np.float64)
+
+def _axis(values, axis):
+    # Position of each value on the axis, -1 if it is not on it
+    if len(axis) == 0:
+        return np.full(len(values), -1)
+    position = np.searchsorted(axis, values)
+    position = np.clip(position, 0, len(axis) - 1)
+    found = axis[position] == values
+    return np.where(found, position, -1)
+
+def exposure_matrix(annual, columns, operators, years):
+    """
+    Miles operated per operator and report year. \n
+    ---------- \n
+    annual : DataFrame \n
+        Annual report data with OPERATOR_ID and REPORT_YEAR.
+    columns : list of str \n
+        Mileage columns added together.
+    operators, years : ndarray \n
+        Sorted axes of the matrix.
+
+    Returns
+    -------
+    ndarray
+        Miles, shape (operators, years).
+
+    """
+    rows = _axis(annual['OPERATOR_ID'].to_numpy(), operators)
+    cols = _axis(annual['REPORT_YEAR'].to_numpy(), years)
+    miles = annual[columns].to_numpy(dtype=np.float64, na_value=0.0).sum(axis=1)
+    keep = (rows >= 0) & (cols >= 0)
+    return _accumulate(rows[keep], cols[keep], miles[keep],
+                       (len(operators), len(years)), sparse=False)
+
+def incident_matrix(incidents, operators, years, sparse = False):
+    """
+    Number of incidents per operator and year. \n
+    ---------- \n
+    incidents : DataFrame \n
+        Incident data with OPERATOR_ID and LOCAL_DATETIME.
+    operators, years : ndarray \n
+        Sorted axes of the matrix.
+    sparse : bool \n
+        Return a scipy.sparse CSR matrix.
+
+    Returns
+    -------
+    ndarray or csr_matrix
+        Incident counts, shape (operators, years).
+
+    """
+    rows = _axis(incidents['OPERATOR_ID'].to_numpy(), operators)
+    year = pd.to_datetime(incidents['LOCAL_DATETIME'], errors='coerce').dt.year
+    cols = _axis(year.to_numpy(dtype=np.float64, na_value=np.nan), years)
+    keep = (rows >= 0) & (cols >= 0)
+    return _accumulate(rows[keep], cols[keep], None,
+                       (len(operators), len(years)), sparse)
+
+# =============================================================================
+# INCIDENT RATES
+# =============================================================================
+
+def _divide(counts, miles):
+    # Rate per per_miles; cells without mileage have no rate
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(miles > 0, counts * per_miles / miles, np.nan)
+
+def incident_rates(incidents, annual, classes = None, sparse = False, latest = True):
+    """
+    Incidents per 1,000 miles for every operator and year, by class. \n
+    ---------- \n
+    incidents : DataFrame \n
+        Output of data_incident.
+    annual : DataFrame \n
+        Part A to D output of data_report.
+    classes : dict \n
+        Rate classes, see rate_classes (the default).
+    sparse : bool \n
+        Return the incident counts as scipy.sparse CSR matrices.
+    latest : bool \n
+        Keep only the latest supplement of each annual report first.
+
+    Returns
+    -------
+    result : dict
+        operators : ndarray, OPIDs (rows)
+        years     : ndarray, report years (columns)
+        exposure  : dict of ndarray, miles per class (rate and exposure
+                    only classes)
+        incidents : dict of ndarray, incident counts per rate class
+        rates     : dict of ndarray, incidents per 1,000 miles per class
+        total     : dict of ndarray, rate of all the operators per year
+
+    """
+    if classes is None:
+        classes = rate_classes
+    if latest and {'REPORT_NUMBER', 'SUPPLEMENTAL_NUMBER'} <= set(annual.columns):
+        annual = data_dedupe.latest_supplement(annual)
+
+    # Shared axes: every operator and year with mileage
+    operators = np.unique(annual['OPERATOR_ID'].dropna().to_numpy())
+    years = np.unique(annual['REPORT_YEAR'].dropna().to_numpy())
+
+    result = {'operators': operators,
+              'years': years,
+              'exposure': {},
+              'incidents': {},
+              'rates': {},
+              'total': {}}
+    for name, (flag, columns) in classes.items():
+        subset = incidents
+        if flag is not None:
+            subset = incidents[incidents[flag[0]].to_numpy() == flag[1]]
+        miles = exposure_matrix(annual, columns, operators, years)
+        counts = incident_matrix(subset, operators, years, sparse)
+        dense = counts.toarray() if sparse else counts
+        result['exposure'][name] = miles
+        result['incidents'][name] = counts
+        result['rates'][name] = _divide(dense, miles)
+        result['total'][name] = _divide(dense.sum(axis=0), miles.sum(axis=0))
+    for name, columns in exposure_classes.items():
+        if name not in result['exposure']:
+            result['exposure'][name] = exposure_matrix(annual, columns, operators, years)
+    return result
+
+def rates_frame(result):
+    """
+    Long table of the rates of incident_rates, one row per operator and
+    year with mileage. \n
+    ---------- \n
+    result : dict \n
+        Output of incident_rates.
+
+    Returns
+    -------
+    DataFrame
+        OPERATOR_ID, REPORT_YEAR, then the miles, incidents and rate of each
+        rate class.
+
+    """
+    operators, years = result['operators'], result['years']
+    frame = {'OPERATOR_ID': np.repeat(operators, len(years)),
+             'REPORT_YEAR': np.tile(years, len(operators))}
+    for name, rates in result['rates'].items():
+        counts = result['incidents'][name]
+        counts = counts.toarray() if hasattr(counts, 'toarray') else counts
+        frame['MILES_' + name.upper()] = result['exposure'][name].ravel()
+        frame['INCIDENTS_' + name.upper()] = counts.ravel()
+        frame['RATE_' + name.upper()] = rates.ravel()
+    frame = pd.DataFrame(frame)
+    miles = frame[[c for c in frame.columns if c.startswith('MILES_')]]
+    return frame[(miles > 0).any(axis=1).to_numpy()].reset_index(drop=True)
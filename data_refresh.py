@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental Refresh
+
+The objective of this module is to update the curated data when PHMSA
+republishes the 2010-present incident and annual report workbooks, without
+curating everything again.
+
+Every processed workbook leaves a snapshot: the hash of each report row, the
+curated tables and the incident rate matrices. A new copy of the workbook is
+compared with the snapshot by report number:
+    new       : report not in the snapshot
+    changed   : report in the snapshot, with another supplement or values
+    withdrawn : report in the snapshot that is no longer published
+Only the new and changed rows are curated. The rows of the changed and
+withdrawn reports are removed from the curated tables (lifetimes, IC and EC
+splits), and the rate matrices are updated by subtracting the counts and
+miles of the removed rows and adding those of the new rows.
+"""
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import data_annual
+import data_cache
+import data_dedupe
+import data_incident
+import data_rate
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# REFRESH SETTINGS
+# =============================================================================
+
+# Report key and supplement of both the incident and annual workbooks
+report_key = 'REPORT_NUMBER'
+supplement_key = 'SUPPLEMENTAL_NUMBER'
+
+# =============================================================================
+# ROW FINGERPRINTS
+# =============================================================================
+
+def row_hashes(data, key = report_key):
+    """
+    Fingerprint every report row. \n
+    ---------- \n
+    data : DataFrame \n
+        Report data with one row per report (latest supplement).
+    key : str \n
+        Report key.
+
+    Returns
+    -------
+    Series
+        uint64 hash of the values of each row (supplement included), indexed
+        by report key.
+
+    """
+    hashes = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    return pd.Series(hashes, index=pd.Index(data[key].to_numpy(), name=key), name='ROW_HASH')
+
+def changes(previous, current):
+    """
+    Compare two sets of row fingerprints. \n
+    ---------- \n
+    previous, current : Series \n
+        Output of row_hashes.
+
+    Returns
+    -------
+    DataFrame
+        One row per new, changed or withdrawn report: report key and status.
+
+    """
+    position = previous.index.get_indexer(current.index)
+    new = position < 0
+    changed = ~new & (previous.to_numpy()[np.maximum(position, 0)] != current.to_numpy())
+    withdrawn = ~previous.index.isin(current.index)
+    name = current.index.name or previous.index.name
+    return pd.DataFrame({name: np.concatenate([current.index[new], current.index[changed],
+                                               previous.index[withdrawn]]),
+                         'status': ['new'] * int(new.sum()) + ['changed'] * int(changed.sum()) +
+                                   ['withdrawn'] * int(withdrawn.sum())})
+
+# =============================================================================
+# SNAPSHOTS
+# =============================================================================
+
+def _snapshot_stem(file_path, label):
+    # One snapshot per source workbook and curation
+    name, key = data_cache._source_key(file_path)
+    folder = os.path.join(data_cache.cache_dir, 'refresh')
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, '{}.{}.{}'.format(name, label, key))
+
+def _load_snapshot(stem):
+    meta = data_cache._read_meta(stem)
+    if meta is None:
+        return None, {}
+    tables = {}
+    for name, fmt in meta['tables'].items():
+        tables[name] = data_cache._read_data({'stem': stem + '.' + name, 'format': fmt})
+    tables['hashes'] = tables['hashes'].set_index(meta['key'])['ROW_HASH']
+    return meta, tables
+
+def _save_snapshot(stem, file_path, key, tables):
+    meta = dict(data_cache.fingerprint(file_path), stem=stem, key=key, tables={})
+    for name, table in tables.items():
+        if name == 'hashes':
+            table = table.reset_index()
+        meta['tables'][name] = data_cache._write_data(table, stem + '.' + name)
+    data_cache._write_meta(meta)
+    return meta
+
+def _version(hashes):
+    # Identifier of a set of row fingerprints, independent of the row order
+    return hashlib.sha256(np.sort(hashes.to_numpy()).tobytes()).hexdigest()[:16]
+
+def _refresh(file_path, label, current, curate, split):
+    # Compare the current rows with the snapshot and curate only the delta
+    stem = _snapshot_stem(file_path, label)
+    meta, snapshot = _load_snapshot(stem)
+    hashes = row_hashes(current)
+    if meta is None:
+        delta = pd.DataFrame({report_key: hashes.index.to_numpy(), 'status': 'new'})
+        previous = None
+        curated = curate(current)
+        removed = curated.iloc[:0]
+        added = curated
+    else:
+        delta = changes(snapshot['hashes'], hashes)
+        previous = _version(snapshot['hashes'])
+        stale = delta.loc[delta['status'] != 'new', report_key]
+        fresh = delta.loc[delta['status'] != 'withdrawn', report_key]
+        old = snapshot['data']
+        drop = old[report_key].isin(stale).to_numpy()
+        removed = old[drop]
+        added = curate(current[current[report_key].isin(fresh).to_numpy()])
+        curated = pd.concat([old[~drop], added], ignore_index=True)
+
+    _save_snapshot(stem, file_path, report_key, {'data': curated, 'hashes': hashes})
+    return dict(split(curated), changes=delta, removed=removed, added=added,
+                previous=previous, version=_version(hashes))
+
+# =============================================================================
+# INCIDENT AND ANNUAL REFRESH
+# =============================================================================
+
+def _incident_rows(category_bin):
+    # Mapped columns of the incident workbook, latest supplement of each report
+    source = data_incident.file_path(category_bin)
+    columns = data_incident.mapped_columns(category_bin) + [report_key, supplement_key]
+    current = data_cache.read_excel(source, columns=columns)
+    if supplement_key in current.columns:
+        current = data_dedupe.latest_supplement(current, report_key, supplement_key)
+    return source, current
+
+def _counted_incidents(category_bin, failure_cause, material, source, current, label):
+    # Incidents counted by the rates: every incident of the cause and
+    # material, including those without installation or manufacture years
+    var = data_incident.mapping()[category_bin]
+    def select(data):
+        if label == 'all':
+            return data
+        mask = (data[var['Failure Cause']] == 'CORROSION FAILURE') & \
+            (data[var['Material']] == 'CARBON STEEL')
+        return data[mask.to_numpy()]
+    return _refresh(source, 'counted_' + label, current, select, lambda data: {'data': data})
+
+def refresh_incident(category = 'gas_transmission', year_bin = 3, failure_cause = 'corrosion',
+                     material = 'carbon_steel'):
+    """
+    Update the curated incident data from a new copy of the workbook. \n
+    ---------- \n
+    category, year_bin, failure_cause, material : \n
+        Same as data_incident. Corrosion of carbon steel, or all the causes
+        and materials.
+
+    Returns
+    -------
+    result : dict
+        data      : DataFrame, curated data, including the lifetimes
+        data_IC   : DataFrame, internal corrosion (corrosion of carbon steel)
+        data_EC   : DataFrame, external corrosion (corrosion of carbon steel)
+        partitions: dict, same as data_incident (all causes and materials)
+        changes   : DataFrame, new, changed and withdrawn reports
+        removed   : DataFrame, curated rows dropped from the previous
+                    snapshot (changed and withdrawn reports)
+        added     : DataFrame, curated rows of the new and changed reports
+        previous  : str, version of the previous snapshot, None if there was
+                    no snapshot (everything is curated)
+        version   : str, version of the new snapshot
+
+    """
+    category_bin = category + '_' + str(year_bin)
+    source, current = _incident_rows(category_bin)
+    var = data_incident.mapping()[category_bin]
+    if failure_cause == 'all' and material == 'all':
+        label = 'all'
+        def curate(data):
+            return data_incident._lifetimes(data, var)
+        def split(data):
+            return {'data': data}
+    elif category == 'gas_transmission' and failure_cause == 'corrosion' and material == 'carbon_steel':
+        label = 'corrosion_carbon_steel'
+        def curate(data):
+            return data_incident.curate(data, category_bin, flag_material='CARBON STEEL',
+                                        flag_cause='CORROSION FAILURE')[0]
+        def split(data):
+            groups = data.groupby(var['Failure Cause Details'], sort=False, observed=True).indices
+            empty = np.array([], dtype=np.intp)
+            return {'data': data,
+                    'data_IC': data.iloc[groups.get('INTERNAL CORROSION', empty)],
+                    'data_EC': data.iloc[groups.get('EXTERNAL CORROSION', empty)]}
+    else:
+        raise ValueError('No incremental curation for {} {} {}'.format(category_bin, failure_cause,
+                                                                       material))
+
+    result = _refresh(source, label, current, curate, split)
+    if label == 'all':
+        keys = [var['Failure Cause'], var['Failure Cause Details'], var['Material']]
+        result['partitions'] = result['data'].groupby(keys, sort=False, dropna=False,
+                                                      observed=True).indices
+    return result
+
+def refresh_annual(category = 'gas_transmission', year_bin = 2):
+    """
+    Update the annual report data (Parts A to D, latest supplements) from a
+    new copy of the workbook. \n
+    ---------- \n
+    category, year_bin : \n
+        Same as data_report.
+
+    Returns
+    -------
+    result : dict
+        data, changes, removed, added, previous, version : \n
+            Same as refresh_incident.
+
+    """
+    category_bin = category + '_' + str(year_bin)
+    source = data_annual.file_path(category_bin)
+    columns = data_annual.mapped_columns(category_bin) + [report_key, supplement_key]
+    current = data_cache.read_excel(source, 0, columns)
+    if supplement_key in current.columns:
+        current = data_dedupe.latest_supplement(current, report_key, supplement_key)
+    return _refresh(source, 'parts_a_d', current, lambda data: data, lambda data: {'data': data})
+
+# =============================================================================
+# RATE MATRICES
+# =============================================================================
+
+def _expand(matrix, operators, years, new_operators, new_years):
+    # Place a matrix on larger axes; the new cells are 0
+    rows = data_rate._axis(operators, new_operators)
+    cols = data_rate._axis(years, new_years)
+    if hasattr(matrix, 'tocoo'):
+        from scipy import sparse as sp
+        coo = matrix.tocoo()
+        return sp.coo_matrix((coo.data, (rows[coo.row], cols[coo.col])),
+                             shape=(len(new_operators), len(new_years))).tocsr()
+    expanded = np.zeros((len(new_operators), len(new_years)))
+    expanded[np.ix_(rows, cols)] = matrix
+    return expanded
+
+def update_rates(result, incidents_removed, incidents_added, annual_removed, annual_added,
+                 classes = None, incidents = None):
+    """
+    Update the output of data_rate.incident_rates with the rows removed from
+    and added to the incident and annual data. \n
+    ---------- \n
+    result : dict \n
+        Output of data_rate.incident_rates.
+    incidents_removed, incidents_added : DataFrame \n
+        Incident rows removed and added.
+    annual_removed, annual_added : DataFrame \n
+        Annual report rows (latest supplements) removed and added.
+    classes : dict \n
+        Same as data_rate.incident_rates.
+    incidents : DataFrame \n
+        All the current incident rows. Required when the added annual rows
+        bring new operators or years: the incidents of those operators and
+        years may already be in the previous snapshot, so the incident
+        counts are then recounted from all the rows.
+
+    Returns
+    -------
+    result : dict
+        Same as data_rate.incident_rates. Operators and years of the added
+        annual rows extend the axes.
+
+    """
+    if classes is None:
+        classes = data_rate.rate_classes
+    operators, years = result['operators'], result['years']
+    new_operators = np.union1d(operators, annual_added['OPERATOR_ID'].dropna().to_numpy())
+    new_years = np.union1d(years, annual_added['REPORT_YEAR'].dropna().to_numpy())
+    grow = len(new_operators) > len(operators) or len(new_years) > len(years)
+    if grow and incidents is None:
+        raise ValueError('The axes grow: update_rates needs all the current incidents')
+
+    updated = {'operators': new_operators,
+               'years': new_years,
+               'exposure': {},
+               'incidents': {},
+               'rates': {},
+               'total': {}}
+    for name, miles in result['exposure'].items():
+        if grow:
+            miles = _expand(miles, operators, years, new_operators, new_years)
+        columns = classes[name][1] if name in classes else data_rate.exposure_classes[name]
+        miles = miles - data_rate.exposure_matrix(annual_removed, columns, new_operators, new_years) + \
+            data_rate.exposure_matrix(annual_added, columns, new_operators, new_years)
+        updated['exposure'][name] = miles
+    for name, counts in result['incidents'].items():
+        flag = classes[name][0]
+        sparse = hasattr(counts, 'tocoo')
+        if grow:
+            # Incidents counted before their annual report arrived were
+            # outside the old axes: recount from all the rows
+            subset = incidents
+            if flag is not None:
+                subset = subset[subset[flag[0]].to_numpy() == flag[1]]
+            counts = data_rate.incident_matrix(subset, new_operators, new_years, sparse)
+        else:
+            for sign, delta in [(-1, incidents_removed), (1, incidents_added)]:
+                if flag is not None:
+                    delta = delta[delta[flag[0]].to_numpy() == flag[1]]
+                counts = counts + sign * data_rate.incident_matrix(delta, new_operators, new_years,
+                                                                   sparse)
+        dense = counts.toarray() if sparse else counts
+        miles = updated['exposure'][name]
+        updated['incidents'][name] = counts
+        updated['rates'][name] = data_rate._divide(dense, miles)
+        updated['total'][name] = data_rate._divide(dense.sum(axis=0), miles.sum(axis=0))
+    return updated
+
+def refresh_rates(category = 'gas_transmission', incident_bin = 3, annual_bin = 2,
+                  failure_cause = 'corrosion', material = 'carbon_steel', classes = None,
+                  sparse = False):
+    """
+    Refresh the incident and annual data, then update the incident rates by
+    the delta of both. The rates are computed from scratch the first time,
+    or when the stored rates do not match the previous snapshots. They count
+    every incident of the cause and material, not only the curated ones with
+    installation and manufacture years. \n
+    ---------- \n
+    category : str \n
+        Same as data_incident.
+    incident_bin, annual_bin : int \n
+        Year bins of the incident and annual workbooks.
+    failure_cause, material : str \n
+        Curation of the incidents, same as refresh_incident.
+    classes : dict \n
+        Same as data_rate.incident_rates.
+    sparse : bool \n
+        Same as data_rate.incident_rates.
+
+    Returns
+    -------
+    rates : dict
+        Same as data_rate.incident_rates.
+    incident : dict
+        Output of refresh_incident.
+    annual : dict
+        Output of refresh_annual.
+
+    """
+    incident = refresh_incident(category, incident_bin, failure_cause, material)
+    annual = refresh_annual(category, annual_bin)
+
+    # The rates count the loaded incidents of the cause and material, not
+    # only the curated ones, with their own snapshot of the same rows
+    category_bin = category + '_' + str(incident_bin)
+    label = 'all' if failure_cause == 'all' and material == 'all' else failure_cause + '_' + material
+    source, current = _incident_rows(category_bin)
+    counted = _counted_incidents(category_bin, failure_cause, material, source, current, label)
+
+    # The rates are kept per curation, like the curated snapshots: the
+    # snapshot versions hash the source rows, so they do not tell the
+    # curations apart
+    path = _snapshot_stem(source, 'rates_' + label) + '.pkl'
+    stored = None
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            stored = pickle.load(f)
+    # The class definitions are part of the settings, so stored rates with
+    # other exposure columns are recomputed rather than updated
+    settings = repr((label, classes or data_rate.rate_classes, data_rate.exposure_classes, sparse))
+    if stored is not None and stored['incident'] == counted['previous'] and \
+            stored['annual'] == annual['previous'] and stored['settings'] == settings:
+        rates = update_rates(stored['rates'], counted['removed'], counted['added'],
+                             annual['removed'], annual['added'], classes, counted['data'])
+    else:
+        rates = data_rate.incident_rates(counted['data'], annual['data'], classes, sparse, latest=False)
+
+    with open(path, 'wb') as f:
+        pickle.dump({'incident': counted['version'],
+                     'annual': annual['version'],
+                     'settings': settings,
+                     'rates': rates}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return rates, incident, annual
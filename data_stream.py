@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming Reader
+
+The objective of this module is to process the large historical workbooks
+(annual reports 1970-2000 and the incident year bins 0 to 2) without loading
+a whole sheet at once. The rows are read with the read-only row iterator of
+openpyxl and yielded as fixed-size chunks; the projection, the curation
+filters and the aggregations (mileage sums, incident counts) are applied to
+each chunk and the partial results are merged at the end. The peak memory is
+then set by chunk_rows and the size of the results, not by the file size.
+The mileage sums only count the latest supplement of every annual report,
+tracked across the chunks.
+
+The historical workbooks have no variable mapping in df, so their source
+column names are passed explicitly.
+"""
+
+import os
+from operator import itemgetter
+
+import numpy as np
+import data_annual
+import data_incident
+import data_lazy
+import data_trace
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# STREAM SETTINGS
+# =============================================================================
+
+# Rows per chunk
+chunk_rows = 50000
+# Historical incident workbooks in data_incident.path, by year bin
+incident_files = {0: 'incident_gas_transmission_gathering_1970_mid1984.xlsx',
+                  1: 'incident_gas_transmission_gathering_mid1984_2001.xlsx',
+                  2: 'incident_gas_transmission_gathering_2002_dec2009.xlsx',
+                  }
+# Historical annual report workbooks, by year bin (data_annual.file_year)
+annual_files = {0: 'annual_gas_transmission_gathering_1970_2000.xlsx',
+                }
+# Annual report columns: a report is one operator and year, and its latest
+# supplement has the highest supplemental number
+report_columns = ['OPERATOR_ID', 'REPORT_YEAR']
+supplement_column = 'SUPPLEMENTAL_NUMBER'
+
+def file_path(kind, year_bin):
+    """
+    Path to a historical gas transmission workbook. \n
+    ---------- \n
+    kind : str \n
+        incident or annual
+    year_bin : int \n
+        Year bin of incident_files or annual_files.
+
+    Returns
+    -------
+    str
+        Path to the workbook.
+
+    """
+    if kind == 'incident':
+        return os.path.join(data_incident.path, incident_files[year_bin])
+    if kind == 'annual':
+        folder = data_annual.file_cat[0] + '_' + data_annual.file_year[year_bin]
+        return os.path.join(data_annual.file_dir, data_annual.file_cat[0], folder,
+                            annual_files[year_bin])
+    raise ValueError('Unknown kind: {}'.format(kind))
+
+# =============================================================================
+# CHUNKED READ
+# =============================================================================
+
+def read_chunks(file_path, sheet_name = 0, columns = None, chunk_size = None):
+    """
+    Read a sheet of an Excel workbook in chunks of rows. The first row is
+    the header. \n
+    ---------- \n
+    file_path : str \n
+        Path to the workbook.
+    sheet_name : int or str \n
+        Sheet to read, by position or name.
+    columns : list of str \n
+        Only keep these columns. Requested columns that are not in the sheet
+        are ignored. If None, every column is kept.
+    chunk_size : int \n
+        Rows per chunk. Defaults to chunk_rows.
+
+    Yields
+    ------
+    DataFrame
+        Up to chunk_size rows of the sheet. Empty rows are skipped.
+
+    """
+    from openpyxl import load_workbook
+    chunk_size = chunk_size or chunk_rows
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        if isinstance(sheet_name, int):
+            sheet = workbook.worksheets[sheet_name]
+        else:
+            sheet = workbook[sheet_name]
+        rows = sheet.iter_rows(values_only=True)
+        header = [None if name is None else str(name).strip() for name in next(rows, ())]
+
+        # Projection: positions of the kept columns in every row
+        if columns is None:
+            names = [name for name in header if name is not None]
+        else:
+            present = set(header)
+            names = [c for c in dict.fromkeys(columns) if c in present]
+        positions = [header.index(name) for name in names]
+        width = len(header)
+        if len(positions) == 1:
+            project = lambda row: (row[positions[0]],)
+        elif positions:
+            project = itemgetter(*positions)
+        else:
+            project = lambda row: ()
+
+        chunk = []
+        for row in rows:
+            if len(row) < width:
+                row = row + (None,) * (width - len(row))
+            values = project(row)
+            if all(value is None for value in values):
+                continue
+            chunk.append(values)
+            if len(chunk) == chunk_size:
+                yield pd.DataFrame.from_records(chunk, columns=names)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame.from_records(chunk, columns=names)
+    finally:
+        workbook.close()
+
+def _filter(chunk, filters, notna):
+    # Boolean mask of the rows that pass the equality and not-null filters
+    mask = np.ones(len(chunk), dtype=bool)
+    for column, value in (filters or {}).items():
+        if isinstance(value, (list, tuple, set)):
+            mask &= chunk[column].isin(value).to_numpy()
+        else:
+            mask &= (chunk[column] == value).to_numpy()
+    for column in notna or []:
+        mask &= chunk[column].notna().to_numpy()
+    return mask
+
+def _check(chunk, columns, file_path):
+    missing = [c for c in columns if c not in chunk.columns]
+    if missing:
+        raise ValueError('Columns not in {}: {}'.format(file_path, missing))
+
+def reduce_chunks(chunks, func, name = 'reduce'):
+    """
+    Apply a partial aggregation to every chunk and merge the partial results
+    by adding them. \n
+    ---------- \n
+    chunks : iterable of DataFrame \n
+        Chunks, e.g. from read_chunks.
+    func : callable \n
+        Takes a chunk and returns a Series or DataFrame of additive values
+        indexed by group.
+    name : str \n
+        Stage name of every chunk in the trace (see data_trace).
+
+    Returns
+    -------
+    Series or DataFrame
+        Sum of the partial results over the chunks, or None if there are no
+        chunks.
+
+    """
+    total = None
+    for chunk in chunks:
+        with data_trace.stage(name, None, chunk) as stage:
+            part = func(chunk)
+            stage.rows(part)
+        if total is None:
+            total = part
+        else:
+            total = total.add(part, fill_value=0)
+    return total
+
+# =============================================================================
+# STREAMED AGGREGATIONS
+# =============================================================================
+
+def incident_counts(file_path, by, sheet_name = 0, filters = None, notna = None,
+                    date_column = None, chunk_size = None):
+    """
+    Count the incidents of a workbook by group, one chunk at a time. \n
+    ---------- \n
+    file_path : str \n
+        Path to the incident workbook, e.g. file_path('incident', 1).
+    by : list of str \n
+        Source columns to group by. YEAR is derived from date_column.
+    sheet_name : int or str \n
+        Sheet to read.
+    filters : dict \n
+        Keep the rows where each column equals the value (or is in the list
+        of values), e.g. {'CAUSE': 'CORROSION'}.
+    notna : list of str \n
+        Keep the rows where these columns are not empty.
+    date_column : str \n
+        Incident date column. Its year is added as the YEAR group column.
+    chunk_size : int \n
+        Rows per chunk. Defaults to chunk_rows.
+
+    Returns
+    -------
+    Series
+        Number of incidents per group, sorted by group.
+
+    """
+    by = list(by)
+    keys = [c for c in by if c != 'YEAR' or date_column is None]
+    columns = keys + list(filters or {}) + list(notna or [])
+    if date_column is not None:
+        columns.append(date_column)
+
+    def count(chunk):
+        _check(chunk, columns, file_path)
+        chunk = chunk.loc[_filter(chunk, filters, notna)]
+        if date_column is not None:
+            chunk = chunk.assign(YEAR=pd.to_datetime(chunk[date_column], errors='coerce').dt.year)
+        return chunk.groupby(by, dropna=False).size()
+
+    chunks = read_chunks(file_path, sheet_name, columns, chunk_size)
+    counts = reduce_chunks(chunks, count, 'stream_counts')
+    if counts is None:
+        return pd.Series(dtype='int64', name='INCIDENTS')
+    return counts.sort_index().astype('int64').rename('INCIDENTS')
+
+def _latest_reports(chunks, needed, file_path):
+    # Running dict of the latest supplement of every report: one projected
+    # row per report is kept, whatever the number of chunks
+    reports = {}
+    for chunk in chunks:
+        with data_trace.stage('stream_latest', None, chunk) as stage:
+            _check(chunk, needed, file_path)
+            keys = zip(*(chunk[c] for c in report_columns))
+            numbers = pd.to_numeric(chunk[supplement_column], errors='coerce').fillna(-np.inf)
+            rows = chunk[needed].itertuples(index=False, name=None)
+            for key, number, row in zip(keys, numbers, rows):
+                kept = reports.get(key)
+                # Equal supplements: the last row wins, as in data_dedupe
+                if kept is None or number >= kept[0]:
+                    reports[key] = (number, row)
+            stage.rows(len(reports))
+    return pd.DataFrame.from_records([row for _, row in reports.values()], columns=needed)
+
+def mileage_sums(file_path, by, columns, sheet_name = 0, filters = None, latest = True,
+                 chunk_size = None):
+    """
+    Sum the mileage columns of an annual report workbook by group, one chunk
+    at a time. \n
+    ---------- \n
+    file_path : str \n
+        Path to the annual report workbook, e.g. file_path('annual', 0).
+    by : list of str \n
+        Source columns to group by, e.g. ['REPORT_YEAR'].
+    columns : list of str \n
+        Mileage columns to sum. Non numeric entries are ignored.
+    sheet_name : int or str \n
+        Sheet to read.
+    filters : dict \n
+        Keep the rows where each column equals the value (or is in the list
+        of values).
+    latest : bool \n
+        Only sum the latest supplement of every report (report_columns),
+        with the highest supplement_column. The latest rows are kept in a
+        running dict while streaming, so the memory grows with the number of
+        reports, not with the file. The filters apply to the latest rows.
+    chunk_size : int \n
+        Rows per chunk. Defaults to chunk_rows.
+
+    Returns
+    -------
+    DataFrame
+        Sum of every mileage column per group, sorted by group.
+
+    """
+    by = list(by)
+    columns = list(columns)
+    needed = by + columns + list(filters or {})
+    if latest:
+        needed += report_columns + [supplement_column]
+    needed = list(dict.fromkeys(needed))
+
+    def total(chunk):
+        _check(chunk, needed, file_path)
+        chunk = chunk.loc[_filter(chunk, filters, None)]
+        miles = chunk[columns].apply(pd.to_numeric, errors='coerce')
+        return miles.groupby([chunk[c] for c in by], dropna=False).sum()
+
+    chunks = read_chunks(file_path, sheet_name, needed, chunk_size)
+    if latest:
+        reports = _latest_reports(chunks, needed, file_path)
+        sums = total(reports) if len(reports) else None
+    else:
+        sums = reduce_chunks(chunks, total, 'stream_mileage')
+    if sums is None:
+        return pd.DataFrame(columns=columns, dtype='float64')
+    return sums.sort_index()
+
+# =============================================================================
+# STREAMED CURATION
+# =============================================================================
+
+def curate_chunks(file_path, var, sheet_name = 0, flag_material = 'CARBON STEEL',
+                  flag_cause = 'CORROSION FAILURE', chunk_size = None):
+    """
+    Curate an incident workbook one chunk at a time, with the filters of
+    data_incident.curate. Only the curated rows of every chunk are kept. \n
+    ---------- \n
+    file_path : str \n
+        Path to the incident workbook, e.g. file_path('incident', 0).
+    var : dict or Series \n
+        Source column of each variable of data_incident.df_index, e.g.
+        data_incident.mapping()['gas_transmission_3'] for the 2010-present
+        workbook. Material, Failure Cause, Failure Cause Details, Incident
+        Date, Installation Year and Manufactured Year are required.
+    sheet_name : int or str \n
+        Sheet to read.
+    flag_material : str \n
+        Keep the rows with this material.
+    flag_cause : str \n
+        Keep the rows with this cause.
+    chunk_size : int \n
+        Rows per chunk. Defaults to chunk_rows.
+
+    Yields
+    ------
+    DataFrame
+        Curated rows of a chunk, with the LIFE_MANUFACTURED and
+        LIFE_INSTALLED columns.
+
+    """
+    var = pd.Series(var)
+    columns = [c for key, c in var.items() if key != 'File Name' and pd.notna(c)]
+    filters = {var['Material']: flag_material, var['Failure Cause']: flag_cause}
+    notna = [var['Installation Year'], var['Manufactured Year']]
+    for chunk in read_chunks(file_path, sheet_name, columns, chunk_size):
+        with data_trace.stage('stream_curate', None, chunk) as stage:
+            _check(chunk, list(filters) + notna + [var['Incident Date']], file_path)
+            chunk = chunk.loc[_filter(chunk, filters, notna)]
+            chunk = data_incident._lifetimes(chunk, var)
+            stage.rows(chunk)
+        yield chunk
+
+def curate(file_path, var, sheet_name = 0, flag_material = 'CARBON STEEL',
+           flag_cause = 'CORROSION FAILURE', chunk_size = None):
+    """
+    Curate an incident workbook one chunk at a time and concatenate the
+    curated rows. Same results as data_incident.curate, without loading the
+    whole sheet. \n
+    ---------- \n
+    file_path : str \n
+        Same as curate_chunks.
+    var : dict or Series \n
+        Same as curate_chunks.
+    sheet_name : int or str \n
+        Sheet to read.
+    flag_material : str \n
+        Keep the rows with this material.
+    flag_cause : str \n
+        Keep the rows with this cause.
+    chunk_size : int \n
+        Rows per chunk. Defaults to chunk_rows.
+
+    Returns
+    -------
+    data : DataFrame
+        Curated data with the LIFE_MANUFACTURED and LIFE_INSTALLED columns.
+    data_IC : DataFrame
+        Rows with CAUSE_DETAILS = INTERNAL CORROSION.
+    data_EC : DataFrame
+        Rows with CAUSE_DETAILS = EXTERNAL CORROSION.
+
+    """
+    chunks = list(curate_chunks(file_path, var, sheet_name, flag_material, flag_cause,
+                                chunk_size))
+    if not chunks:
+        raise ValueError('No rows in {}'.format(file_path))
+    data = pd.concat(chunks, ignore_index=True)
+    details = data[pd.Series(var)['Failure Cause Details']]
+    data_IC = data.loc[(details == 'INTERNAL CORROSION').to_numpy()]
+    data_EC = data.loc[(details == 'EXTERNAL CORROSION').to_numpy()]
+    return data, data_IC, data_EC
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Survival Analysis
+
+The objective of this module is to estimate the remaining useful life of the
+pipelines from the age at failure of the curated incidents (LIFE_INSTALLED)
+and, optionally, the miles of pipe at risk by decade installed (Part J of the
+annual reports).
+
+Every stratum (IC vs EC, diameter, coating, seam type, ...) is processed at
+once: the events are sorted a single time by (stratum, age) and the
+Kaplan-Meier, Nelson-Aalen and Weibull estimates are cumulative sums and
+group sums over the sorted arrays.
+"""
+
+import numpy as np
+import data_annual
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# AT-RISK POPULATION
+# =============================================================================
+
+# Start year assumed for the Part J "before 1940" bin
+pre1940_start = 1930
+
+def miles_at_risk(ages, decade_miles, report_year):
+    """
+    Miles of pipe at least a given age, from the Part J miles by decade
+    installed. The pipe is assumed to be installed uniformly within each
+    decade. \n
+    ---------- \n
+    ages : array_like \n
+        Ages in years.
+    decade_miles : array_like \n
+        Miles per decade installed, in data_annual.decade_bins order.
+    report_year : int \n
+        Year of the annual report.
+
+    Returns
+    -------
+    ndarray
+        Miles with an age of at least each of the ages.
+
+    """
+    start = np.where(np.isfinite(data_annual.decade_start),
+                     data_annual.decade_start, pre1940_start).astype(np.float64)
+    # Share of each decade older than the age, for every age at once
+    share = np.clip((report_year - start[None, :] - np.asarray(ages, dtype=np.float64)[:, None]) / 10,
+                    0, 1)
+    return share @ np.asarray(decade_miles, dtype=np.float64)
+
+# =============================================================================
+# KAPLAN-MEIER AND NELSON-AALEN
+# =============================================================================
+
+def _group_cumsum(values, first):
+    # Cumulative sum restarted at the first row of every group
+    total = np.cumsum(values)
+    offset = (total - values)[first]
+    return total - np.repeat(offset, np.diff(np.append(first, len(values))))
+
+def survival(data, by = None, life = 'LIFE_INSTALLED', population = None, report_year = None,
+             years_observed = 1):
+    """
+    Kaplan-Meier and Nelson-Aalen estimates of every stratum. \n
+    ---------- \n
+    data : DataFrame \n
+        Curated incident data, e.g. data_IC or data_EC of data_incident.
+    by : list of str \n
+        Variables that define the strata, e.g. ['CAUSE_DETAILS',
+        'PIPE_COATING_TYPE']. If None, the data is a single stratum.
+    life : str \n
+        Age at failure, in years.
+    population : array_like or dict \n
+        Part J miles by decade installed, shared by all the strata or one per
+        stratum key. If None, the risk set is the number of failures at or
+        after each age.
+    report_year : int \n
+        Year of the population, required with population.
+    years_observed : float \n
+        Years of incidents observed against the population. The risk set is
+        then in mile-years.
+
+    Returns
+    -------
+    curves : DataFrame
+        One row per stratum and distinct age: stratum code, age, events,
+        at_risk, hazard, km (survival) and na (cumulative hazard).
+    strata : DataFrame
+        Stratum keys, indexed by stratum code.
+
+    """
+    data = data[data[life].notna().to_numpy()]
+    ages = data[life].to_numpy(dtype=np.float64)
+    if by:
+        codes = data.groupby(by, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+        strata = data[by].drop_duplicates().reset_index(drop=True)
+    else:
+        codes = np.zeros(len(ages), dtype=np.intp)
+        strata = pd.DataFrame(index=[0])
+
+    # Sort once by (stratum, age) and keep one row per distinct age
+    order = np.lexsort((ages, codes))
+    ages, codes = ages[order], codes[order]
+    new = np.ones(len(ages), dtype=bool)
+    new[1:] = (codes[1:] != codes[:-1]) | (ages[1:] != ages[:-1])
+    rows = np.flatnonzero(new)
+    events = np.diff(np.append(rows, len(ages)))
+    stratum, age = codes[rows], ages[rows]
+    first = np.flatnonzero(np.append(True, stratum[1:] != stratum[:-1]))
+
+    # Risk set: failures at or after the age, or the population at risk
+    if population is None:
+        ends = np.cumsum(np.bincount(codes, minlength=len(strata)))
+        at_risk = (ends[stratum] - rows).astype(np.float64)
+    else:
+        at_risk = np.empty(len(age))
+        for code in np.unique(stratum):
+            miles = population
+            if isinstance(population, dict):
+                miles = population[tuple(strata.iloc[code])] if by else population[code]
+            mask = stratum == code
+            at_risk[mask] = miles_at_risk(age[mask], miles, report_year) * years_observed
+
+    # Ages without anyone at risk have no hazard and do not add to the curves
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hazard = np.where(at_risk > 0, events / at_risk, np.nan)
+    step = np.nan_to_num(hazard)
+    # Kaplan-Meier product as a sum of logs within each stratum. A step of 1
+    # (every pipe at risk fails) ends the curve at 0; it is counted apart so
+    # the -inf of its log does not carry into the next strata
+    ended = _group_cumsum((step >= 1).astype(np.float64), first) > 0
+    log_km = _group_cumsum(np.log1p(-np.where(step < 1, step, 0)), first)
+    km = np.where(ended, 0.0, np.exp(log_km))
+    na = _group_cumsum(step, first)
+
+    curves = pd.DataFrame({'stratum': stratum,
+                           'age': age,
+                           'events': events,
+                           'at_risk': at_risk,
+                           'hazard': hazard,
+                           'km': km,
+                           'na': na})
+    return curves, strata
+
+# =============================================================================
+# WEIBULL HAZARD
+# =============================================================================
+
+def fit_weibull(curves):
+    """
+    Fit a Weibull cumulative hazard H(t) = (t / scale)^shape to the
+    Nelson-Aalen curve of every stratum. The fit is a least squares line of
+    log H against log t, computed for all the strata with group sums. \n
+    ---------- \n
+    curves : DataFrame \n
+        Output of survival.
+
+    Returns
+    -------
+    DataFrame
+        shape, scale and the number of events of each stratum code. Strata
+        with fewer than two usable ages have NaN parameters.
+
+    """
+    usable = (curves['age'] > 0) & (curves['na'] > 0) & np.isfinite(curves['na'])
+    x = np.log(curves.loc[usable, 'age'].to_numpy())
+    y = np.log(curves.loc[usable, 'na'].to_numpy())
+    code = curves.loc[usable, 'stratum'].to_numpy()
+    size = int(curves['stratum'].max()) + 1 if len(curves) else 0
+
+    n = np.bincount(code, minlength=size).astype(np.float64)
+    sx, sy = np.bincount(code, x, size), np.bincount(code, y, size)
+    sxx, sxy = np.bincount(code, x * x, size), np.bincount(code, x * y, size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shape = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        intercept = (sy - shape * sx) / n
+        scale = np.exp(-intercept / shape)
+    shape[n < 2] = np.nan
+    scale[n < 2] = np.nan
+    events = np.bincount(curves['stratum'], curves['events'], size)
+    return pd.DataFrame({'shape': shape,
+                         'scale': scale,
+                         'events': events.astype(np.int64)})
+
+def weibull_hazard(t, shape, scale):
+    """
+    Weibull hazard rate h(t) = (shape / scale) (t / scale)^(shape - 1). \n
+    ---------- \n
+    t : array_like \n
+        Ages in years.
+    shape, scale : float or array_like \n
+        Weibull parameters, e.g. from fit_weibull.
+
+    Returns
+    -------
+    ndarray
+        Hazard rate at each age.
+
+    """
+    t = np.asarray(t, dtype=np.float64)
+    return (shape / scale) * (t / scale) ** (shape - 1)
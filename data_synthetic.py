@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic PHMSA Data
+
+The objective of this module is to write synthetic incident and annual report
+workbooks with the exact column schemas of data_incident.var_gt_3 and
+data_annual.var_gt_3, so the pipeline can be tested and benchmarked without
+the PHMSA files.
+
+The values follow the shape of the real data: categories with realistic
+frequencies, CAUSE_DETAILS consistent with CAUSE, carbon steel properties
+only for carbon steel, installation years from a Weibull age at failure,
+supplemental reports, and annual mileage whose TOTAL columns add up. The rows
+are generated and written in chunks, so 10M rows do not need 10M rows in
+memory. Besides the workbook, a columnar copy (parquet, one file per sheet)
+can be written for the columnar ingestion benchmarks.
+"""
+
+import os
+
+import numpy as np
+import data_annual
+import data_incident
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# GENERATOR SETTINGS
+# =============================================================================
+
+# Rows generated and written at a time
+chunk_rows = 100000
+# Data rows of an Excel sheet; larger datasets are only written as parquet
+excel_max_rows = 1048575
+# Operators shared by the incident and annual data, and their OPIDs
+operator_count = 1000
+operator_start = 10000
+# Share of the reports that are a supplement of the previous report
+supplement_share = 0.1
+# Report years of the 2010-present data
+first_year = 2010
+last_year = 2024
+
+# Categorical values and frequencies of the incident data
+commodities = (['NATURAL GAS', 'PROPANE GAS', 'SYNTHETIC GAS', 'HYDROGEN GAS', 'LANDFILL GAS'],
+               [0.92, 0.03, 0.02, 0.01, 0.02])
+system_parts = (['ONSHORE PIPELINE, INCLUDING VALVE SITES',
+                 'ONSHORE COMPRESSOR STATION EQUIPMENT AND PIPING',
+                 'ONSHORE REGULATOR/METERING STATION EQUIPMENT AND PIPING',
+                 'OFFSHORE PIPELINE, INCLUDING RISER AND RISER BEND'],
+                [0.6, 0.2, 0.12, 0.08])
+materials = (['CARBON STEEL', 'PLASTIC', 'MATERIAL OTHER THAN CARBON STEEL OR PLASTIC'],
+             [0.8, 0.08, 0.12])
+items = (['PIPE', 'WELD, INCLUDING HEAT-AFFECTED ZONE', 'VALVE', 'FLANGE', 'COMPRESSOR', 'OTHER'],
+         [0.45, 0.1, 0.15, 0.1, 0.1, 0.1])
+diameters = ([2, 4, 6, 8, 10, 12, 16, 20, 24, 26, 30, 36, 42],
+             [0.05, 0.1, 0.12, 0.12, 0.1, 0.1, 0.09, 0.09, 0.08, 0.05, 0.05, 0.03, 0.02])
+smys_grades = ([24000, 35000, 42000, 46000, 52000, 60000, 65000, 70000],
+               [0.05, 0.2, 0.15, 0.1, 0.25, 0.1, 0.1, 0.05])
+specifications = (['API 5L', 'ASTM A106', 'ASTM A53', 'UNKNOWN'], [0.7, 0.1, 0.05, 0.15])
+seam_types = (['LONGITUDINAL ERW - HIGH FREQUENCY', 'LONGITUDINAL ERW - LOW FREQUENCY', 'SEAMLESS',
+               'DSAW', 'SPIRAL WELDED', 'FLASH WELDED', 'UNKNOWN'],
+              [0.3, 0.15, 0.15, 0.15, 0.08, 0.02, 0.15])
+manufacturers = (['UNKNOWN', 'US STEEL', 'NATIONAL TUBE', 'REPUBLIC STEEL', 'KAISER', 'AO SMITH',
+                  'BETHLEHEM STEEL', 'LONE STAR'],
+                 [0.45, 0.1, 0.08, 0.07, 0.07, 0.08, 0.08, 0.07])
+coatings = (['FUSION BONDED EPOXY', 'COAL TAR', 'ASPHALT', 'POLYOLEFIN', 'EXTRUDED POLYETHYLENE',
+             'TAPE', 'PAINT', 'NONE', 'OTHER'],
+            [0.25, 0.2, 0.1, 0.05, 0.1, 0.1, 0.05, 0.05, 0.1])
+plastic_types = (['POLYETHYLENE (PE)', 'POLYVINYL CHLORIDE (PVC)', 'OTHER'], [0.8, 0.1, 0.1])
+plastic_sdrs = ([7, 9, 11, 13.5, 17], [0.1, 0.2, 0.4, 0.2, 0.1])
+# CAUSE, its frequency and its CAUSE_DETAILS
+causes = {'CORROSION FAILURE': (0.25, ['INTERNAL CORROSION', 'EXTERNAL CORROSION']),
+          'EXCAVATION DAMAGE': (0.15, ['EXCAVATION DAMAGE BY THIRD PARTY',
+                                       'EXCAVATION DAMAGE BY OPERATOR (FIRST PARTY)',
+                                       'EXCAVATION DAMAGE BY OPERATOR\'S CONTRACTOR (SECOND PARTY)']),
+          'MATERIAL FAILURE OF PIPE OR WELD': (0.17, ['CONSTRUCTION, INSTALLATION OR FABRICATION-RELATED',
+                                                      'ORIGINAL MANUFACTURING-RELATED',
+                                                      'ENVIRONMENTAL CRACKING-RELATED']),
+          'EQUIPMENT FAILURE': (0.15, ['MALFUNCTION OF CONTROL/RELIEF EQUIPMENT',
+                                       'NON-THREADED CONNECTION FAILURE',
+                                       'THREADED CONNECTION/COUPLING FAILURE']),
+          'NATURAL FORCE DAMAGE': (0.08, ['EARTH MOVEMENT, NOT DUE TO HEAVY RAINS/FLOODS',
+                                          'HEAVY RAINS/FLOODS', 'LIGHTNING']),
+          'OTHER OUTSIDE FORCE DAMAGE': (0.06, ['DAMAGE BY CAR, TRUCK, OR OTHER MOTORIZED VEHICLE',
+                                                'PREVIOUS MECHANICAL DAMAGE']),
+          'INCORRECT OPERATION': (0.08, ['VALVE LEFT OR PLACED IN WRONG POSITION',
+                                         'OTHER INCORRECT OPERATION']),
+          'ALL OTHER CAUSES': (0.06, ['MISCELLANEOUS', 'UNKNOWN']),
+          }
+# Weibull age at failure (years) and share of missing years
+age_shape = 2.5
+age_scale = 45
+missing_installation = 0.15
+missing_manufacture = 0.25
+
+# Annual report sheets and the parts of each sheet
+annual_sheets = {'GT AR Part A to D': ['PARTA', 'PARTB', 'PARTC', 'PARTD'],
+                 'GT AR Part F to G': ['PARTF', 'PARTG'],
+                 'GT AR Part H': ['PARTH'],
+                 'GT AR Part I': ['PARTI'],
+                 'GT AR Part J': ['PARTJ'],
+                 }
+# Columns of every sheet
+annual_keys = ['OPERATOR_ID', 'REPORT_YEAR', 'REPORT_NUMBER', 'SUPPLEMENTAL_NUMBER']
+# Part D materials: CP bare, CP coated, unprotected bare, unprotected coated,
+# cast iron, wrought iron, plastic, composite, other
+part_d_materials = ['CPB', 'CPC', 'CUB', 'CUC', 'CI', 'WI', 'P', 'C', 'O']
+
+# =============================================================================
+# SHARED HELPERS
+# =============================================================================
+
+def _choice(rng, options, size):
+    values, p = options
+    return np.asarray(values)[rng.choice(len(values), size=size, p=np.asarray(p) / np.sum(p))]
+
+def _reports(rng, start, size, report_base):
+    # Report numbers with supplements: a supplement repeats the report number
+    # of the previous row with the next supplemental number. Every chunk starts
+    # with an original report, so the report numbers of the chunks never meet
+    supplement = rng.random(size) < supplement_share
+    supplement[0] = False
+    report = report_base + start + np.cumsum(~supplement) - 1
+    run_start = np.maximum.accumulate(np.where(~supplement, np.arange(size), 0))
+    return report, np.arange(size) - run_start + 1
+
+def _chunks(rows):
+    return [(start, min(chunk_rows, rows - start)) for start in range(0, rows, chunk_rows)]
+
+# =============================================================================
+# INCIDENT DATA
+# =============================================================================
+
+def incident_chunk(rng, start, size):
+    """
+    Generate a chunk of synthetic incident rows. \n
+    ---------- \n
+    rng : Generator \n
+        Random generator of the chunk.
+    start : int \n
+        Position of the first row in the dataset.
+    size : int \n
+        Number of rows.
+
+    Returns
+    -------
+    DataFrame
+        Columns of data_incident.var_gt_3, plus REPORT_NUMBER and
+        SUPPLEMENTAL_NUMBER.
+
+    """
+    report, supplement = _reports(rng, start, size, 20100000)
+    # Operators: a few large operators file most of the reports
+    operator = operator_start + np.minimum(rng.zipf(1.3, size) - 1, operator_count - 1)
+    incident = np.datetime64('{}-01-01'.format(first_year)) + \
+        rng.integers(0, (last_year - first_year + 1) * 365, size).astype('timedelta64[D]')
+    incident = incident + rng.integers(0, 24 * 60, size).astype('timedelta64[m]')
+    year = incident.astype('datetime64[Y]').astype(np.int64) + 1970
+
+    material = _choice(rng, materials, size)
+    steel = material == 'CARBON STEEL'
+    plastic = material == 'PLASTIC'
+    part = _choice(rng, system_parts, size)
+    onshore = ~np.char.startswith(part.astype(str), 'OFFSHORE')
+
+    names = list(causes)
+    cause_code = rng.choice(len(names), size=size, p=[causes[c][0] for c in names])
+    details = [d for c in names for d in causes[c][1]]
+    offsets = np.cumsum([0] + [len(causes[c][1]) for c in names])
+    counts = np.diff(offsets)
+    detail = np.asarray(details)[offsets[cause_code] +
+                                 (rng.random(size) * counts[cause_code]).astype(np.int64)]
+
+    diameter = _choice(rng, diameters, size).astype(np.float64)
+    diameter[~(steel | plastic)] = np.nan
+    thickness = np.round(diameter / rng.uniform(30, 100, size), 3)
+    thickness[~steel] = np.nan
+    sdr = _choice(rng, plastic_sdrs, size).astype(np.float64)
+    sdr[~plastic] = np.nan
+
+    age = np.minimum(rng.weibull(age_shape, size) * age_scale, year - 1900)
+    installed = np.floor(year - age)
+    installed[rng.random(size) < missing_installation] = np.nan
+    manufactured = installed - rng.integers(0, 4, size)
+    manufactured[rng.random(size) < missing_manufacture] = np.nan
+
+    def steel_only(values):
+        values = values.astype(object)
+        values[~steel] = None
+        return values
+
+    postal = np.char.zfill(rng.integers(501, 99951, size).astype(str), 5).astype(object)
+    postal[~onshore] = None
+    plastic_type = _choice(rng, plastic_types, size).astype(object)
+    plastic_type[~plastic] = None
+    smys = _choice(rng, smys_grades, size).astype(np.float64)
+    smys[~steel] = np.nan
+
+    var = data_incident.var_gt_3
+    columns = {'REPORT_NUMBER': report,
+               'SUPPLEMENTAL_NUMBER': supplement,
+               var[1]: operator,
+               var[2]: np.char.add('OPERATOR ', operator.astype(str)),
+               var[3]: incident,
+               var[4]: _choice(rng, commodities, size),
+               var[5]: part,
+               var[6]: postal,
+               var[7]: material,
+               var[8]: _choice(rng, items, size),
+               var[9]: diameter,
+               var[10]: thickness,
+               var[11]: smys,
+               var[12]: steel_only(_choice(rng, specifications, size)),
+               var[13]: steel_only(_choice(rng, seam_types, size)),
+               var[14]: steel_only(_choice(rng, manufacturers, size)),
+               var[15]: steel_only(_choice(rng, coatings, size)),
+               var[16]: plastic_type,
+               var[17]: sdr,
+               var[18]: np.round(diameter / sdr, 3),
+               var[19]: installed,
+               var[20]: manufactured,
+               var[21]: np.asarray(names)[cause_code],
+               var[22]: detail,
+               }
+    return pd.DataFrame(columns)
+
+# =============================================================================
+# ANNUAL REPORT DATA
+# =============================================================================
+
+def _split(rng, total, count, sparsity = 0.5):
+    # Split the totals into count columns with some empty columns
+    weight = rng.exponential(1, (len(total), count)) * (rng.random((len(total), count)) > sparsity)
+    weight[weight.sum(axis=1) == 0, 0] = 1
+    return np.round(total[:, None] * weight / weight.sum(axis=1, keepdims=True), 2)
+
+def annual_chunk(rng, start, size):
+    """
+    Generate a chunk of synthetic annual report rows. \n
+    ---------- \n
+    rng : Generator \n
+        Random generator of the chunk.
+    start : int \n
+        Position of the first row in the dataset.
+    size : int \n
+        Number of rows.
+
+    Returns
+    -------
+    DataFrame
+        Columns of data_annual.var_gt_3. The TOTAL columns of Parts B, D,
+        H, I and J are the sums of their components.
+
+    """
+    report, supplement = _reports(rng, start, size, 20110000)
+    position = start + np.arange(size)
+    operator = operator_start + position % operator_count
+    year = first_year + (position // operator_count) % (last_year - first_year + 1)
+    miles = np.round(rng.lognormal(4.5, 1.5, size), 2)
+    offshore = np.where(rng.random(size) < 0.1, np.round(miles * rng.uniform(0, 0.5, size), 2), 0)
+
+    columns = {'OPERATOR_ID': operator,
+               'PARTA2NAMEOFCOMP': np.char.add('OPERATOR ', operator.astype(str)),
+               'REPORT_YEAR': year,
+               'REPORT_NUMBER': report,
+               'SUPPLEMENTAL_NUMBER': supplement,
+               'PARTA5COMMODITY': _choice(rng, commodities, size),
+               }
+
+    # Part B: HCA miles
+    hca = np.round(miles * rng.uniform(0, 0.3, size), 2)
+    columns['PARTBHCAONSHORE'] = hca
+    columns['PARTBHCAOFFSHORE'] = np.zeros(size)
+    columns['PARTBHCATOTAL'] = hca
+
+    # Part C: volumes transported, onshore and offshore by gas
+    for zone, scale in [('ON', miles), ('OFF', offshore)]:
+        values = _split(rng, scale * 50, 5, 0.7)
+        for i, gas in enumerate(['NG', 'PG', 'SG', 'HG', 'LFG']):
+            columns['PARTC' + zone + gas] = values[:, i]
+
+    # Part D: transmission (T) and gathering (G) miles by material
+    gathering = np.round(miles * rng.uniform(0, 0.2, size), 2)
+    groups = {'TON': miles - offshore, 'TOFF': offshore,
+              'GONTA': gathering * 0.6, 'GONTB': gathering * 0.4, 'GOFF': np.zeros(size)}
+    split = {group: _split(rng, total, len(part_d_materials), 0.6) for group, total in groups.items()}
+    names = {'TON': ['PARTDTON' + m if m != 'C' else 'PARTDTON' for m in part_d_materials],
+             'TOFF': ['PARTDTOFF' + m for m in part_d_materials],
+             'GONTA': ['PARTDGONTA' + m for m in part_d_materials],
+             'GONTB': ['PARTDGONTB' + m for m in part_d_materials],
+             'GOFF': ['PARTDGOFF' + m for m in part_d_materials]}
+    totals = {'TON': 'PARTDTONTOTAL', 'TOFF': 'PARTDTOFFTOTAL', 'GONTA': 'PARTDGONATOTAL',
+              'GONTB': 'PARTDGONBTOTAL', 'GOFF': 'PARTDGOFFTOTAL'}
+    for group in groups:
+        for i, name in enumerate(names[group]):
+            columns[name] = split[group][:, i]
+        columns[totals[group]] = split[group].sum(axis=1).round(2)
+    transmission = split['TON'] + split['TOFF']
+    gathering = split['GONTA'] + split['GONTB'] + split['GOFF']
+    for i, m in enumerate(part_d_materials):
+        columns['PARTDT' + m + 'TOTAL'] = transmission[:, i].round(2)
+        columns['PARTDG' + m + 'TOTAL'] = gathering[:, i].round(2)
+        columns['PARTD' + m + 'TOTAL'] = (transmission[:, i] + gathering[:, i]).round(2)
+    columns['PARTDTTOTAL'] = transmission.sum(axis=1).round(2)
+    columns['PARTDGTOTAL'] = gathering.sum(axis=1).round(2)
+    columns['PARTDTOTAL'] = (transmission.sum(axis=1) + gathering.sum(axis=1)).round(2)
+
+    # Parts H and I: miles by nominal pipe size
+    nps = len(data_annual.nps_bins)
+    for part, group, total in [('H', 'onshore', miles - offshore), ('H', 'offshore', offshore),
+                               ('I', 'onshore_a', groups['GONTA']),
+                               ('I', 'onshore_b', groups['GONTB']),
+                               ('I', 'offshore', groups['GOFF'])]:
+        values = _split(rng, total, nps, 0.7)
+        bins = data_annual.bin_columns[part][group]
+        for i, name in enumerate(bins):
+            columns[name] = values[:, i]
+        prefix = bins[0][:-len(data_annual.nps_bins[0])]
+        columns[prefix + '_OTHER_PIPE_DETAIL'] = np.full(size, None, dtype=object)
+        columns[prefix + '_OTHER_PIPE_MILE_TOTAL'] = np.zeros(size)
+        columns[prefix + 'TOTAL'] = values.sum(axis=1).round(2)
+
+    # Part J: transmission miles by decade installed, none after the report
+    decades = len(data_annual.decade_bins)
+    valid = data_annual.decade_start[None, :] <= year[:, None]
+    decade_totals = 0
+    for zone, total in [('ON', miles - offshore), ('OFF', offshore)]:
+        unknown = np.round(total * rng.uniform(0, 0.05, size), 2)
+        weight = rng.exponential(1, (size, decades)) * valid
+        values = np.round((total - unknown)[:, None] * weight / weight.sum(axis=1, keepdims=True), 2)
+        columns['PARTJT' + zone + 'UNKWN'] = unknown
+        for i, name in enumerate(data_annual.decade_bins):
+            columns['PARTJT' + zone + name] = values[:, i]
+        columns['PARTJT' + zone + 'TOTAL'] = (values.sum(axis=1) + unknown).round(2)
+        decade_totals = decade_totals + np.column_stack([unknown, values])
+    columns['PARTJTUNKWNTOT'] = decade_totals[:, 0].round(2)
+    for i, name in enumerate(data_annual.decade_bins):
+        columns['PARTJT' + name + 'TOT'] = decade_totals[:, i + 1].round(2)
+    columns['PARTJTTOTAL'] = decade_totals.sum(axis=1).round(2)
+
+    return pd.DataFrame(columns)[data_annual.var_gt_3[1:]]
+
+def _sheet_columns(columns, parts):
+    return [c for c in columns if c in annual_keys or any(c.startswith(p) for p in parts)]
+
+# =============================================================================
+# WRITERS
+# =============================================================================
+
+class _Writer:
+    # Append chunks of one or more sheets to a workbook and parquet files
+
+    def __init__(self, file_path, sheets, excel, parquet):
+        self.file_path = file_path
+        self.sheets = sheets
+        self.workbook = None
+        self.sheet = {}
+        self.parquet = {}
+        self.schema = {}
+        self.use_parquet = parquet
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        if excel:
+            from openpyxl import Workbook
+            self.workbook = Workbook(write_only=True)
+
+    def parquet_path(self, sheet):
+        stem = os.path.splitext(self.file_path)[0]
+        return stem + ('.parquet' if len(self.sheets) == 1 else '.' + sheet + '.parquet')
+
+    def write(self, sheet, data):
+        if self.workbook is not None:
+            if sheet not in self.sheet:
+                self.sheet[sheet] = self.workbook.create_sheet(sheet)
+                self.sheet[sheet].append(list(data.columns))
+            values = data.astype(object).where(data.notna(), None)
+            for row in values.itertuples(index=False, name=None):
+                self.sheet[sheet].append(row)
+        if self.use_parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if sheet not in self.parquet:
+                schema = pa.Schema.from_pandas(data, preserve_index=False)
+                # Columns that are empty in the first chunk hold strings
+                schema = pa.schema([f.with_type(pa.string()) if pa.types.is_null(f.type) else f
+                                    for f in schema])
+                self.schema[sheet] = schema
+                self.parquet[sheet] = pq.ParquetWriter(self.parquet_path(sheet), schema)
+            table = pa.Table.from_pandas(data, schema=self.schema[sheet], preserve_index=False)
+            self.parquet[sheet].write_table(table)
+
+    def close(self):
+        paths = []
+        if self.workbook is not None:
+            self.workbook.save(self.file_path)
+            paths.append(self.file_path)
+        for sheet, writer in self.parquet.items():
+            writer.close()
+            paths.append(self.parquet_path(sheet))
+        return paths
+
+def _generate(file_path, rows, seed, chunk, sheets, excel, parquet):
+    if excel and rows > excel_max_rows:
+        # Excel sheets cannot hold the rows: only the columnar copy
+        excel = False
+        parquet = True
+    writer = _Writer(file_path, sheets, excel, parquet)
+    seeds = seed.spawn(len(_chunks(rows)))
+    for (start, size), s in zip(_chunks(rows), seeds):
+        data = chunk(np.random.default_rng(s), start, size)
+        for sheet, parts in sheets.items():
+            writer.write(sheet, data if parts is None else data[_sheet_columns(data.columns, parts)])
+    return writer.close()
+
+def generate(root = '.', incident_rows = 10000, annual_rows = 10000, seed = 0, excel = True,
+             parquet = True):
+    """
+    Write the synthetic incident and annual report workbooks at the paths
+    that data_incident and data_annual read, under a root folder. \n
+    ---------- \n
+    root : str \n
+        Folder that plays the role of the working directory.
+    incident_rows, annual_rows : int \n
+        Number of rows. 0 skips the dataset.
+    seed : int \n
+        Seed of the data. The same seed gives the same data.
+    excel : bool \n
+        Write the .xlsx workbook. Datasets with more rows than an Excel
+        sheet holds are only written as parquet.
+    parquet : bool \n
+        Write the columnar copy: <workbook>.parquet, or one
+        <workbook>.<sheet>.parquet per annual report sheet.
+
+    Returns
+    -------
+    list of str
+        Paths of the files written.
+
+    """
+    paths = []
+    incident_seed, annual_seed = np.random.SeedSequence(seed).spawn(2)
+    if incident_rows:
+        file_path = os.path.join(root, data_incident.file_path('gas_transmission_3'))
+        paths += _generate(file_path, incident_rows, incident_seed, incident_chunk,
+                           {'Sheet1': None}, excel, parquet)
+    if annual_rows:
+        file_path = os.path.join(root, data_annual.file_path('gas_transmission_2'))
+        paths += _generate(file_path, annual_rows, annual_seed, annual_chunk,
+                           annual_sheets, excel, parquet)
+    return paths
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Stage Instrumentation
+
+The objective of this module is to record, for every stage of the incident
+and annual processing (read, material filter, year filters, datetime
+conversion, cause filter, IC/EC split, ...), the wall time, the rows in and
+out and the peak memory above the memory at the start of the stage.
+
+Tracing is off by default; the stages then cost a single function call.
+To record a trace:
+    with data_trace.trace() as t:
+        data_incident.data_incident()
+    t.to_frame()
+
+Memoized calls (see data_memo) return without running their stages, and
+worker processes do not report to the trace of the parent process.
+"""
+
+import json
+import time
+import tracemalloc
+
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# TRACE SETTINGS
+# =============================================================================
+
+# Record the peak memory of every stage with tracemalloc. It slows down the
+# traced calls, so it can be turned off to only keep the times and rows
+trace_memory = True
+# JSON lines file where every stage record is appended, or None
+trace_file = None
+
+_active = None
+
+# =============================================================================
+# STAGES
+# =============================================================================
+
+def _rows(value):
+    # Row count of a frame, array or boolean mask, or the count itself
+    if value is None or isinstance(value, int):
+        return value
+    if hasattr(value, 'dtype') and pd.api.types.is_bool_dtype(value.dtype):
+        return int(value.sum())
+    return len(value)
+
+class _NullStage:
+    # Stage returned when tracing is off: every call is a no-op
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def rows(self, value):
+        pass
+
+_null = _NullStage()
+
+class Stage:
+    """
+    A timed stage of a trace, used as a context manager. The rows out are
+    set with rows(); a stage that raises is recorded with its error. \n
+    ---------- \n
+    trace : Trace \n
+        Trace that receives the record.
+    name : str \n
+        Stage name, e.g. 'material_filter'.
+    context : str \n
+        Dataset of the stage, e.g. 'gas_transmission_3'.
+    rows_in : DataFrame, array or int \n
+        Input of the stage, or its row count.
+
+    """
+    def __init__(self, trace, name, context, rows_in):
+        self.trace = trace
+        self.record = {'stage': name,
+                       'context': context,
+                       'depth': len(trace._stack),
+                       'rows_in': _rows(rows_in),
+                       'rows_out': None}
+
+    def rows(self, value):
+        """Set the rows out of the stage: a frame, array, mask or count."""
+        self.record['rows_out'] = _rows(value)
+
+    def __enter__(self):
+        stack = self.trace._stack
+        if self.trace.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # The parent keeps the peak reached before this stage
+                stack[-1]._peak = max(stack[-1]._peak, peak)
+            tracemalloc.reset_peak()
+            self._start_memory = current
+            self._peak = current
+        stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        self.trace._stack.pop()
+        self.record['seconds'] = seconds
+        if self.trace.memory:
+            peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            self.record['peak_mb'] = (peak - self._start_memory) / 2**20
+            if self.trace._stack:
+                parent = self.trace._stack[-1]
+                parent._peak = max(parent._peak, peak)
+        else:
+            self.record['peak_mb'] = None
+        self.record['error'] = None if exc_type is None else exc_type.__name__
+        self.trace._add(self.record)
+        return False
+
+def stage(name, context = None, rows_in = None):
+    """
+    Open a stage of the active trace. \n
+    ---------- \n
+    name : str \n
+        Stage name.
+    context : str \n
+        Dataset of the stage.
+    rows_in : DataFrame, array or int \n
+        Input of the stage, or its row count.
+
+    Returns
+    -------
+    Stage
+        Context manager of the stage. When no trace is active a shared no-op
+        stage is returned.
+
+    """
+    if _active is None:
+        return _null
+    return Stage(_active, name, context, rows_in)
+
+def enabled():
+    """Whether a trace is recording."""
+    return _active is not None
+
+# =============================================================================
+# TRACE
+# =============================================================================
+
+class Trace:
+    """
+    Records of the stages run while the trace is active, in the order they
+    finished (a nested stage before its parent). \n
+    ---------- \n
+    memory : bool \n
+        Record the peak memory of every stage. Defaults to trace_memory.
+    file_path : str \n
+        JSON lines file where every record is appended. Defaults to
+        trace_file.
+
+    """
+    def __init__(self, memory = None, file_path = None):
+        self.memory = trace_memory if memory is None else memory
+        self.file_path = file_path or trace_file
+        self.records = []
+        self._stack = []
+        self._started = False
+
+    def _add(self, record):
+        self.records.append(record)
+        if self.file_path:
+            with open(self.file_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def __enter__(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError('A trace is already active')
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = None
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+        return False
+
+    def to_frame(self):
+        """
+        Records as a DataFrame. \n
+        ---------- \n
+
+        Returns
+        -------
+        DataFrame
+            One row per stage: stage, context, depth, rows_in, rows_out,
+            rows_dropped, seconds, peak_mb and error.
+
+        """
+        columns = ['stage', 'context', 'depth', 'rows_in', 'rows_out', 'seconds', 'peak_mb',
+                   'error']
+        data = pd.DataFrame(self.records, columns=columns)
+        data.insert(5, 'rows_dropped', data['rows_in'].astype(float) - data['rows_out'].astype(float))
+        return data
+
+    def __repr__(self):
+        return '<Trace: {} stages>'.format(len(self.records))
+
+def trace(memory = None, file_path = None):
+    """
+    Record the stages run inside a with block. \n
+    ---------- \n
+    memory : bool \n
+        Record the peak memory of every stage. Defaults to trace_memory.
+    file_path : str \n
+        JSON lines file where every record is appended. Defaults to
+        trace_file.
+
+    Returns
+    -------
+    Trace
+        Context manager; its records are kept after the block.
+
+    """
+    return Trace(memory, file_path)
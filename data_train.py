@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Model Training
+
+The objective of this module is to train and validate the lifetime
+prediction models on the feature arrays of data_features.
+
+The folds of the cross validation run in parallel worker processes. The
+design matrix and the target are placed once in shared memory and every
+worker maps them, instead of receiving a pickled copy per fold. Models that
+take sparse input share the data, indices and indptr arrays of the CSR
+matrix; the others share a dense copy. The fitted
+models and the fold metrics are cached on disk by the hash of the data, the
+model and its hyperparameters, so an unchanged rerun returns immediately.
+"""
+
+import hashlib
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import data_cache
+import data_features
+import data_lazy
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# MODELS
+# =============================================================================
+
+def _hist_gradient_boosting(**params):
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    return HistGradientBoostingRegressor(**params)
+
+def _random_forest(**params):
+    from sklearn.ensemble import RandomForestRegressor
+    return RandomForestRegressor(**params)
+
+def _ridge(**params):
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import Ridge
+    from sklearn.pipeline import make_pipeline
+    return make_pipeline(SimpleImputer(strategy='median'), Ridge(**params))
+
+# Model name and factory; the hyperparameters are passed to the factory
+models = {'hist_gradient_boosting': _hist_gradient_boosting,
+          'random_forest': _random_forest,
+          'ridge': _ridge,
+          }
+# Models fitted on the sparse design matrix (data_features.design_matrix).
+# The other models do not take sparse input, or not with missing values: the
+# one-hot columns are densified once, into a shared block of
+# rows x (numeric + one-hot columns) x 4 bytes
+sparse_models = ['ridge']
+
+# =============================================================================
+# FOLDS
+# =============================================================================
+
+def folds(n, k = 5, groups = None, seed = 0):
+    """
+    Split the rows into k test folds. \n
+    ---------- \n
+    n : int \n
+        Number of rows.
+    k : int \n
+        Number of folds.
+    groups : array_like \n
+        Group of each row, e.g. OPERATOR_ID. All the rows of a group are in
+        the same fold. If None, the rows are shuffled into the folds.
+    seed : int \n
+        Seed of the shuffle.
+
+    Returns
+    -------
+    list of ndarray
+        Row positions of each test fold.
+
+    """
+    rng = np.random.default_rng(seed)
+    if groups is None:
+        return np.array_split(rng.permutation(n), k)
+    # Shuffle the groups, then fill the folds from the largest group down
+    _, inverse, counts = np.unique(np.asarray(groups), return_inverse=True, return_counts=True)
+    shuffled = rng.permutation(len(counts))
+    order = shuffled[np.argsort(-counts[shuffled], kind='stable')]
+    fold_of_group = np.empty(len(counts), dtype=np.intp)
+    sizes = np.zeros(k, dtype=np.intp)
+    for g in order:
+        fold_of_group[g] = np.argmin(sizes)
+        sizes[fold_of_group[g]] += counts[g]
+    fold = fold_of_group[inverse.ravel()]
+    return [np.flatnonzero(fold == i) for i in range(k)]
+
+# =============================================================================
+# PARALLEL CROSS VALIDATION
+# =============================================================================
+
+def _share(array):
+    # Copy an array into a new shared memory block
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def _attach(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def _attach_matrix(specs, shape):
+    # Map a shared dense matrix, or the data, indices and indptr of a CSR one
+    shms, arrays = zip(*[_attach(spec) for spec in specs])
+    if len(arrays) == 1:
+        return shms, arrays[0]
+    from scipy import sparse
+    return shms, sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+def _fit_fold(args):
+    # Worker: map the shared arrays, fit on the training rows, score the test
+    x_specs, shape, y_spec, test, model, params, fold = args
+    x_shms, X = _attach_matrix(x_specs, shape)
+    y_shm, y = _attach(y_spec)
+    try:
+        train = np.ones(len(y), dtype=bool)
+        train[test] = False
+        estimator = models[model](**params)
+        start = time.perf_counter()
+        estimator.fit(X[train], y[train])
+        fit_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        predicted = estimator.predict(X[test])
+        predict_seconds = time.perf_counter() - start
+        actual = np.array(y[test], dtype=np.float64)
+    finally:
+        del X, y
+        for shm in x_shms + (y_shm,):
+            shm.close()
+
+    error = predicted - actual
+    total = np.sum((actual - actual.mean()) ** 2)
+    return estimator, {'fold': fold,
+                       'n_train': int(train.sum()),
+                       'n_test': len(test),
+                       'fit_seconds': fit_seconds,
+                       'predict_seconds': predict_seconds,
+                       'rmse': float(np.sqrt(np.mean(error ** 2))),
+                       'mae': float(np.mean(np.abs(error))),
+                       'r2': float(1 - np.sum(error ** 2) / total) if total > 0 else np.nan}
+
+def _cache_key(arrays, shape, y, test_folds, model, params):
+    sha = hashlib.sha256()
+    for array in list(arrays) + [y] + list(test_folds):
+        sha.update(np.ascontiguousarray(array).tobytes())
+    sha.update(repr((shape, model, sorted(params.items()))).encode('utf-8'))
+    return sha.hexdigest()
+
+def cross_validate(features, model = 'hist_gradient_boosting', params = None, k = 5,
+                   by_operator = False, seed = 0, max_workers = None, cache = True):
+    """
+    k-fold cross validation of a lifetime prediction model, one worker
+    process per fold. \n
+    ---------- \n
+    features : dict \n
+        Output of data_features.features or build_features. The numeric and
+        one-hot features are combined into one float32 matrix: a CSR matrix
+        for the sparse_models, otherwise a dense one.
+    model : str \n
+        Name of the model in models.
+    params : dict \n
+        Hyperparameters of the model.
+    k : int \n
+        Number of folds.
+    by_operator : bool \n
+        Keep all the incidents of an operator in the same fold.
+    seed : int \n
+        Seed of the fold assignment.
+    max_workers : int \n
+        Number of worker processes. Defaults to one per fold.
+    cache : bool \n
+        Reuse the models and metrics of an identical previous run.
+
+    Returns
+    -------
+    result : dict
+        folds  : DataFrame, per fold: sizes, fit and predict seconds, rmse,
+                 mae and r2
+        models : list, fitted model of each fold
+        cached : bool, True if the result came from the cache
+
+    """
+    params = dict(params or {})
+    if model in sparse_models:
+        X = data_features.design_matrix(features)
+        arrays = [X.data, X.indices, X.indptr]
+    else:
+        X = np.ascontiguousarray(np.hstack([features['X'], features['onehot'].toarray()]),
+                                 dtype=np.float32)
+        arrays = [X]
+    y = np.ascontiguousarray(features['y'], dtype=np.float32)
+    groups = features['operator'] if by_operator else None
+    test_folds = folds(len(y), k, groups, seed)
+
+    key = _cache_key(arrays, X.shape, y, test_folds, model, params)
+    cache_path = os.path.join(data_cache.cache_dir, 'models', key + '.pkl')
+    if cache and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            result = pickle.load(f)
+        result['cached'] = True
+        return result
+
+    # The arrays are copied once into shared memory for all the folds
+    x_shms, x_specs = zip(*[_share(array) for array in arrays])
+    y_shm, y_spec = _share(y)
+    try:
+        tasks = [(x_specs, X.shape, y_spec, test, model, params, i)
+                 for i, test in enumerate(test_folds)]
+        with ProcessPoolExecutor(max_workers=max_workers or k) as pool:
+            fitted = list(pool.map(_fit_fold, tasks))
+    finally:
+        for shm in x_shms + (y_shm,):
+            shm.close()
+            shm.unlink()
+
+    result = {'folds': pd.DataFrame([metrics for _, metrics in fitted]),
+              'models': [estimator for estimator, _ in fitted],
+              'cached': False}
+    if cache:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return result
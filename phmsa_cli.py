@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Command Line
+
+The objective of this module is to run the batch jobs (see data_pipeline)
+from the command line. It is installed as the phmsa script:
+    phmsa job.json --max-workers 4
+
+Without a job spec, the default job is run: the 2010-present corrosion of
+carbon steel, with the incident rates, lifetime fits, histogram and scatter
+matrix.
+"""
+import argparse
+import json
+
+import data_pipeline
+
+def main(argv = None):
+    """
+    Parse the command line and run the job. \n
+    ---------- \n
+    argv : list of str \n
+        Command line arguments. Defaults to sys.argv.
+
+    Returns
+    -------
+    int
+        Exit status: 1 if a stage failed.
+
+    """
+    parser = argparse.ArgumentParser(description='Run a PHMSA batch job.')
+    parser.add_argument('spec', nargs='?',
+                        help='JSON job spec (categories, eras, causes, materials, operators, '
+                             'fit, plots, output); default job if omitted')
+    parser.add_argument('--max-workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true',
+                        help='run every stage, even with a valid output')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the stages that would run')
+    parser.add_argument('--output', default=None,
+                        help='output folder (overrides the job spec)')
+    args = parser.parse_args(argv)
+
+    spec = {}
+    if args.spec:
+        with open(args.spec, 'r') as f:
+            spec = json.load(f)
+    if args.output:
+        spec['output'] = args.output
+
+    report = data_pipeline.run_job(spec, args.max_workers, args.force, args.dry_run)
+    for row in report.itertuples():
+        line = '{:<8} {:>8.2f}s  {}'.format(row.status, row.seconds, row.stage)
+        if isinstance(row.error, str):
+            line += '  ' + row.error
+        print(line)
+    return int((report['status'] == 'failed').any())
+
+if __name__ == '__main__':
+    raise SystemExit(main())
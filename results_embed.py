@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Low-Dimensional Embedding
+
+The objective of this module is to compute the t-SNE embedding of the
+incident features for the multi-dimensional plots, without recomputing it on
+every run.
+
+The embedding uses the Barnes-Hut approximation (O(n log n)) with a PCA
+initialization and is cached by the hash of the feature matrix. When the
+feature matrix only appends new incidents to a cached one, the new points are
+placed into the existing embedding at the distance weighted mean of their
+nearest cached neighbors, instead of computing the embedding again.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import data_cache
+# =============================================================================
+# EMBEDDING SETTINGS
+# =============================================================================
+
+# Nearest cached neighbors used to place an appended point
+placement_neighbors = 10
+# Recompute from scratch when more than this share of the points is new
+max_appended_share = 0.25
+
+# =============================================================================
+# FEATURE ARRAY
+# =============================================================================
+
+def feature_array(features):
+    """
+    Finite float32 matrix to embed, from the output of
+    data_features.features. The numeric features are log1p scaled and missing
+    values are 0; both transforms are fixed, so appending incidents does not
+    change the rows already embedded. \n
+    ---------- \n
+    features : dict \n
+        Output of data_features.features or build_features.
+
+    Returns
+    -------
+    ndarray
+        float32 matrix, rows x (numeric + one-hot) features.
+
+    """
+    numeric = np.log1p(np.abs(features['X'])) * np.sign(features['X'])
+    numeric = np.nan_to_num(numeric, nan=0.0, posinf=0.0, neginf=0.0)
+    return np.ascontiguousarray(np.hstack([numeric, features['onehot'].toarray()]),
+                                dtype=np.float32)
+
+# =============================================================================
+# CACHE
+# =============================================================================
+
+def _folder():
+    return os.path.join(data_cache.cache_dir, 'embeddings')
+
+def _hash(X, params):
+    sha = hashlib.sha256(np.ascontiguousarray(X).tobytes())
+    sha.update(repr((X.shape[1:], X.dtype.str, sorted(params.items()))).encode('utf-8'))
+    return sha.hexdigest()
+
+def _entries(params):
+    # Cached embeddings with the same parameters, largest first
+    folder = _folder()
+    if not os.path.isdir(folder):
+        return []
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith('.json'):
+            with open(os.path.join(folder, name), 'r') as f:
+                meta = json.load(f)
+            if meta['params'] == params:
+                entries.append(meta)
+    return sorted(entries, key=lambda meta: -meta['rows'])
+
+def _save(key, embedding, params):
+    os.makedirs(_folder(), exist_ok=True)
+    np.save(os.path.join(_folder(), key + '.npy'), embedding)
+    with open(os.path.join(_folder(), key + '.json'), 'w') as f:
+        json.dump({'key': key, 'rows': len(embedding), 'params': params}, f)
+
+def _load(key):
+    return np.load(os.path.join(_folder(), key + '.npy'))
+
+# =============================================================================
+# EMBEDDING
+# =============================================================================
+
+def place(X_old, embedding_old, X_new, neighbors = None):
+    """
+    Place new points into an existing embedding at the inverse distance
+    weighted mean of their nearest old neighbors. \n
+    ---------- \n
+    X_old : ndarray \n
+        Features of the embedded points.
+    embedding_old : ndarray \n
+        Their embedding.
+    X_new : ndarray \n
+        Features of the new points.
+    neighbors : int \n
+        Number of neighbors. Defaults to placement_neighbors.
+
+    Returns
+    -------
+    ndarray
+        Embedding of the new points.
+
+    """
+    from sklearn.neighbors import NearestNeighbors
+    neighbors = min(neighbors or placement_neighbors, len(X_old))
+    distance, index = NearestNeighbors(n_neighbors=neighbors).fit(X_old).kneighbors(X_new)
+    weight = 1 / np.maximum(distance, 1e-12)
+    weight /= weight.sum(axis=1, keepdims=True)
+    return np.einsum('ij,ijk->ik', weight, embedding_old[index]).astype(embedding_old.dtype)
+
+def embed(X, dimensions = 2, perplexity = 30.0, seed = 0, cache = True):
+    """
+    t-SNE embedding of a feature matrix, cached and updated incrementally. \n
+    ---------- \n
+    X : ndarray \n
+        Finite feature matrix, e.g. from feature_array.
+    dimensions : int \n
+        Dimensions of the embedding.
+    perplexity : float \n
+        t-SNE perplexity.
+    seed : int \n
+        Random state of t-SNE.
+    cache : bool \n
+        Use and update the embedding cache.
+
+    Returns
+    -------
+    embedding : ndarray
+        rows x dimensions.
+    status : str
+        cached ~ same feature matrix as a cached one \n
+        appended ~ new rows placed into a cached embedding \n
+        computed ~ computed from scratch
+
+    """
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    params = {'dimensions': dimensions, 'perplexity': perplexity, 'seed': seed}
+    key = _hash(X, params)
+    if cache:
+        for meta in _entries(params):
+            if meta['key'] == key:
+                return _load(key), 'cached'
+            rows = meta['rows']
+            if rows < len(X) and (len(X) - rows) <= max_appended_share * len(X) and \
+                    _hash(X[:rows], params) == meta['key']:
+                # Only appended rows: keep the cached points where they are
+                old = _load(meta['key'])
+                embedding = np.vstack([old, place(X[:rows], old, X[rows:])])
+                _save(key, embedding, params)
+                return embedding, 'appended'
+
+    from sklearn.manifold import TSNE
+    tsne = TSNE(n_components=dimensions, perplexity=min(perplexity, (len(X) - 1) / 3),
+                init='pca', method='barnes_hut', random_state=seed)
+    embedding = tsne.fit_transform(X).astype(np.float32)
+    if cache:
+        _save(key, embedding, params)
+    return embedding, 'computed'
@@ -6,36 +6,101 @@ Plot the results of the predictions. Use various methods of multi-dimensional
 plotting, such as seaborn.pairplot(), t-SNE, overlapped scatter plots.
 """
 
-import matplotlib.pyplot as plt
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import data_lazy
+plt = data_lazy.lazy_import('matplotlib.pyplot')
+colors = data_lazy.lazy_import('matplotlib.colors')
+backend_agg = data_lazy.lazy_import('matplotlib.backends.backend_agg')
+figure = data_lazy.lazy_import('matplotlib.figure')
+pd = data_lazy.lazy_import('pandas')
+# =============================================================================
+# PLOT SETTINGS
+# =============================================================================
+
+# Above this number of rows the plots are drawn from pre-binned densities,
+# so the render time does not grow with the data
+density_threshold = 10000
+# Number of bins per axis in density mode
+density_bins = 200
+hist_bins = 100
+
+def _density_mode(mode, rows):
+    if mode == 'auto':
+        return rows > density_threshold
+    return mode == 'density'
+
+def _finite(*values):
+    # Keep the rows where all the values are finite
+    values = [np.asarray(v, dtype=np.float64) for v in values]
+    keep = np.logical_and.reduce([np.isfinite(v) for v in values])
+    return [v[keep] for v in values]
 
 # =============================================================================
 # DATA ANALYSIS: PLOTTING
 # =============================================================================
 
-def hist(data, df):
+def hist(data, df, mode = 'auto', fig = None):
+    """
+    Histogram of the lifetime from installation. \n
+    ---------- \n
+    mode : str \n
+        bars ~ bins chosen by matplotlib ('auto') \n
+        density ~ fixed number of bins, counted with np.histogram \n
+        auto ~ density above density_threshold rows
+    fig : Figure \n
+        Draw on this figure instead of the current pyplot figure.
+    """
+
+    if mode not in ('auto', 'bars', 'density'):
+        raise ValueError('Unknown histogram mode: {}'.format(mode))
 
     # Plot a Histogram of the PART_LIFETIME
     hist_data = data['LIFE_INSTALLED']
+    ax = plt.gca() if fig is None else fig.gca()
     
-    n, bins, patches = plt.hist(x=hist_data, bins='auto', color='#0504aa', 
-                                alpha=0.75, rwidth=0.9)
-    plt.grid(axis='y', alpha=0.75)
-    plt.xlabel('Lifetime from Installation')
-    plt.ylabel('Frequency')
-    plt.title('Detection Time Histogram')
+    if _density_mode(mode, len(hist_data)):
+        # Pre-binned counts: fixed render cost
+        values, = _finite(hist_data)
+        n, bins = np.histogram(values, bins=hist_bins)
+        ax.stairs(n, bins, fill=True, color='#0504aa', alpha=0.75)
+    else:
+        n, bins, patches = ax.hist(x=hist_data, bins='auto', color='#0504aa', 
+                                   alpha=0.75, rwidth=0.9)
+    ax.grid(axis='y', alpha=0.75)
+    ax.set_xlabel('Lifetime from Installation')
+    ax.set_ylabel('Frequency')
+    ax.set_title('Detection Time Histogram')
     # plt.text(23, 60, r'$\mu=15, b=3$')
     # maxfreq = n.max()
     # Set a clean upper y-axis limit
     # plt.ylim(ymax=np.ceil(maxfreq / 10) * 10 if maxfreq % 10 else maxfreq + 10)
     # plt.xlim(xmax=np.ceil(maxfreq / 5) * 5 if maxfreq % 5 else maxfreq + 5)
     
-def scatter_matrix(data, df):
+def scatter_matrix(data, df, mode = 'auto', fig = None):
+    """
+    Variables vs lifetime from installation. \n
+    ---------- \n
+    mode : str \n
+        scatter ~ one marker per row \n
+        density ~ 2-D histogram of density_bins per axis, drawn as an image \n
+        auto ~ density above density_threshold rows
+    fig : Figure \n
+        Draw on this figure instead of a new pyplot figure.
+    """
     # Scatter Plots: Observe the change in PART_LIFETIME
     # fig2, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2,2, sharey=True, figsize=(10,8))
-    fig2, axs = plt.subplots(2,2, 
-                             # sharey=True, 
-                             figsize=(10,8))
+    if fig is None:
+        fig2, axs = plt.subplots(2,2, 
+                                 # sharey=True, 
+                                 figsize=(10,8))
+    else:
+        fig2 = fig
+        fig2.set_size_inches(10, 8)
+        axs = fig2.subplots(2,2)
     fig2.suptitle('Variables vs Part Lifetime in Years', fontsize=24)
     y_val = 'LIFE_INSTALLED'
     x_val = ['PIPE_DIAMETER',
@@ -54,20 +119,33 @@ def scatter_matrix(data, df):
     #          variables[10]]
     # xlim = np.array([[0,0,0,0],[500,500,20,1]])
     
+    density = _density_mode(mode, len(data))
+    y_data = data[y_val].to_numpy(dtype=np.float64, na_value=np.nan)
     j = 0
     k = 0
     for i in range(len(x_val)):
         if i == 2:
             j += 1
             k -= 2
-        axs[j,k].scatter(x=np.array(data[x_val[i]]),
-                         y=np.array(data[y_val]),
-                         s=s,
-                         c=c[i],
-                         label=label[i])
+        x_data = data[x_val[i]].to_numpy(dtype=np.float64, na_value=np.nan)
+        if density:
+            # Pre-binned counts drawn as an image: fixed render cost
+            x, y = _finite(x_data, y_data)
+            counts, x_edges, y_edges = np.histogram2d(x, y, bins=density_bins)
+            axs[j,k].imshow(np.ma.masked_equal(counts.T, 0), origin='lower',
+                            extent=[x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]],
+                            aspect='auto', interpolation='nearest',
+                            norm=colors.LogNorm(), cmap='viridis')
+            axs[j,k].set_title(label[i])
+        else:
+            axs[j,k].scatter(x=x_data,
+                             y=y_data,
+                             s=s,
+                             c=c[i],
+                             label=label[i])
+            axs[j,k].legend()
         # axs[j,k].set_xlim(xlim[:,i])
         axs[j,k].set_ylabel('Part Lifetime [years]')
-        axs[j,k].legend()
         axs[j,k].grid()
         k += 1
         
@@ -78,4 +156,69 @@ def scatter_matrix(data, df):
     # plt.scatter(x=np.array(data[x_val]),y=np.array(data[y1_val]), s=0.75, c='blue')
     # plt.scatter(x=np.array(data[x_val]),y=np.array(data[y2_val]), s=0.75, c='red')
     # plt.ylim([0, 100])
-    # plt.show()
\ No newline at end of file
+    # plt.show()
+
+# =============================================================================
+# DATA ANALYSIS: BATCH EXPORT
+# =============================================================================
+
+# Plot functions available by name in the plot specs
+plots = {'hist': hist,
+         'scatter_matrix': scatter_matrix,
+         }
+
+def render(spec):
+    """
+    Draw one figure on its own Figure with the non-interactive Agg canvas,
+    without pyplot, and save it. This is the worker of export. \n
+    ---------- \n
+    spec : dict \n
+        Figure spec, see export.
+
+    Returns
+    -------
+    dict
+        Output path and render seconds of the figure.
+
+    """
+    start = time.perf_counter()
+    plot = spec['plot']
+    plot = plots[plot] if isinstance(plot, str) else plot
+    fig = figure.Figure()
+    backend_agg.FigureCanvasAgg(fig)
+    plot(spec['data'], spec.get('df'), fig=fig, **spec.get('kwargs', {}))
+    folder = os.path.dirname(spec['path'])
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    fig.savefig(spec['path'], dpi=spec.get('dpi', 100))
+    # The figure is not registered with pyplot, so nothing keeps it alive
+    fig.clear()
+    return {'path': spec['path'],
+            'seconds': time.perf_counter() - start}
+
+def export(specs, max_workers = None):
+    """
+    Render a batch of figures to files in parallel worker processes. Each
+    figure is drawn on its own Figure with the non-interactive Agg canvas,
+    so no pyplot state is shared or left behind. \n
+    ---------- \n
+    specs : list of dict \n
+        plot   : name in plots, or a module level function that takes
+                 (data, df, fig=fig, **kwargs) \n
+        data   : DataFrame to plot \n
+        path   : output file; the format follows the extension \n
+        df     : variable mapping (optional) \n
+        kwargs : extra arguments of the plot function (optional) \n
+        dpi    : resolution (optional, 100)
+    max_workers : int \n
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    DataFrame
+        Output path and render seconds of each figure, in spec order.
+
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        timings = list(pool.map(render, specs))
+    return pd.DataFrame(timings)